@@ -0,0 +1 @@
+"""Benchmarks for the Buttplug integration."""
@@ -0,0 +1,306 @@
+"""Stand-in Buttplug server for benchmarks and manual testing.
+
+Speaks just enough of the Buttplug v1 JSON protocol for the integration: the
+handshake, device list/added/removed, scanning, ping and the vibrate, rotate,
+linear and stop commands. Devices are simulated; commands are acknowledged after
+a configurable delay and recorded with the time they arrived.
+
+Run standalone with e.g. ``python -m benchmarks.fake_server --devices 10``.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+from dataclasses import dataclass, field
+import json
+import logging
+import time
+from typing import Any
+
+import websockets
+
+_LOGGER = logging.getLogger(__name__)
+
+ERROR_MSG = 3
+ERROR_DEVICE = 4
+
+# Message layouts cycled through when simulating devices.
+DEVICE_TEMPLATES: list[tuple[str, dict[str, dict[str, int]]]] = [
+    ("Fake Vibrator", {"VibrateCmd": {"FeatureCount": 2}}),
+    (
+        "Fake Rotator",
+        {"VibrateCmd": {"FeatureCount": 1}, "RotateCmd": {"FeatureCount": 1}},
+    ),
+    ("Fake Stroker", {"LinearCmd": {"FeatureCount": 1}}),
+]
+
+DEVICE_COMMANDS = {"VibrateCmd", "RotateCmd", "LinearCmd", "StopDeviceCmd"}
+
+
+@dataclass
+class FakeDevice:
+    """A simulated device."""
+
+    index: int
+    name: str
+    messages: dict[str, dict[str, int]]
+
+    def as_dict(self) -> dict[str, Any]:
+        """Return the device as it appears in DeviceList/DeviceAdded."""
+        messages = {name: dict(attrs) for name, attrs in self.messages.items()}
+        messages["StopDeviceCmd"] = {}
+        return {
+            "DeviceName": self.name,
+            "DeviceIndex": self.index,
+            "DeviceMessages": messages,
+        }
+
+
+@dataclass
+class ReceivedCommand:
+    """A device command as received by the server."""
+
+    received: float  # time.monotonic()
+    name: str
+    body: dict[str, Any]
+
+
+@dataclass
+class FakeButtplugServer:
+    """Websocket server simulating a Buttplug server with some devices."""
+
+    device_count: int = 1
+    message_delay: float = 0.0  # seconds before a command is acknowledged
+    host: str = "127.0.0.1"
+    port: int = 0  # 0 picks a free port
+    server_name: str = "Fake Buttplug Server"
+    max_ping_time: int = 0  # ms; clients that don't ping within it are dropped
+    scan_duration: float = 0.0  # seconds until a scan finishes; 0 never finishes
+    devices: dict[int, FakeDevice] = field(default_factory=dict)
+    received: list[ReceivedCommand] = field(default_factory=list)
+    record: bool = True
+
+    def __post_init__(self) -> None:
+        """Create the simulated devices."""
+        self._server: Any = None
+        self._connections: set[Any] = set()
+        self._last_ping: dict[Any, float] = {}
+        self.handshakes = 0
+        self._responses: set[asyncio.Task] = set()
+        self._scanning = False
+        self._scan_timer: asyncio.TimerHandle | None = None
+        self.scans = 0
+        self._next_index = 0
+        for _ in range(self.device_count):
+            self._create_device()
+
+    @property
+    def address(self) -> str:
+        """Return the websocket address of the server."""
+        return f"ws://{self.host}:{self.port}"
+
+    def _create_device(self) -> FakeDevice:
+        index = self._next_index
+        self._next_index += 1
+        name, messages = DEVICE_TEMPLATES[index % len(DEVICE_TEMPLATES)]
+        device = self.devices[index] = FakeDevice(index, f"{name} {index}", messages)
+        return device
+
+    async def start(self) -> None:
+        """Start listening."""
+        self._server = await websockets.serve(self._handle, self.host, self.port)
+        self.port = next(iter(self._server.sockets)).getsockname()[1]
+        _LOGGER.info("Fake Buttplug server listening on %s", self.address)
+
+    async def stop(self) -> None:
+        """Close all connections and stop listening."""
+        if self._server is None:
+            return
+        self._server.close()
+        if self._scan_timer is not None:
+            self._scan_timer.cancel()
+            self._scan_timer = None
+        self._scanning = False
+        for task in self._responses:
+            task.cancel()
+        await self._server.wait_closed()
+        self._server = None
+        self._connections.clear()
+
+    async def add_device(self) -> FakeDevice:
+        """Simulate a device connecting to the server."""
+        device = self._create_device()
+        await self._broadcast({"DeviceAdded": {"Id": 0, **device.as_dict()}})
+        return device
+
+    async def remove_device(self, index: int) -> None:
+        """Simulate a device disconnecting from the server."""
+        self.devices.pop(index)
+        await self._broadcast({"DeviceRemoved": {"Id": 0, "DeviceIndex": index}})
+
+    async def _broadcast(self, message: dict[str, Any]) -> None:
+        payload = json.dumps([message])
+        for websocket in list(self._connections):
+            await websocket.send(payload)
+
+    async def _handle(self, websocket: Any, path: str | None = None) -> None:
+        """Serve a single client connection."""
+        self._connections.add(websocket)
+        self._last_ping[websocket] = time.monotonic()
+        watchdog = (
+            asyncio.create_task(self._enforce_pings(websocket))
+            if self.max_ping_time
+            else None
+        )
+        try:
+            async for raw in websocket:
+                received = time.monotonic()
+                for message in json.loads(raw):
+                    ((name, body),) = message.items()
+                    if name == "Ping":
+                        self._last_ping[websocket] = received
+                    # Handle each message separately so slow acknowledgements
+                    # don't hold up the ones behind them, like a real server.
+                    task = asyncio.create_task(
+                        self._respond(websocket, received, name, body)
+                    )
+                    self._responses.add(task)
+                    task.add_done_callback(self._responses.discard)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self._connections.discard(websocket)
+            self._last_ping.pop(websocket, None)
+            if watchdog is not None:
+                watchdog.cancel()
+
+    async def _enforce_pings(self, websocket: Any) -> None:
+        """Drop a client that doesn't ping within the maximum ping time."""
+        limit = self.max_ping_time / 1000
+        while True:
+            await asyncio.sleep(limit / 4)
+            if time.monotonic() - self._last_ping[websocket] > limit:
+                await websocket.close()
+                return
+
+    async def _respond(
+        self, websocket: Any, received: float, name: str, body: dict[str, Any]
+    ) -> None:
+        reply = self._reply(received, name, body)
+        if name in DEVICE_COMMANDS or name == "StopAllDevices":
+            if self.message_delay:
+                await asyncio.sleep(self.message_delay)
+        try:
+            await websocket.send(json.dumps([reply]))
+        except websockets.ConnectionClosed:
+            pass
+
+    def _reply(
+        self, received: float, name: str, body: dict[str, Any]
+    ) -> dict[str, Any]:
+        msg_id = body.get("Id", 0)
+        ok = {"Ok": {"Id": msg_id}}
+        if name == "RequestServerInfo":
+            self.handshakes += 1
+            return {
+                "ServerInfo": {
+                    "Id": msg_id,
+                    "ServerName": self.server_name,
+                    "MajorVersion": 0,
+                    "MinorVersion": 0,
+                    "BuildVersion": 0,
+                    "MessageVersion": 1,
+                    "MaxPingTime": self.max_ping_time,
+                }
+            }
+        if name == "RequestDeviceList":
+            return {
+                "DeviceList": {
+                    "Id": msg_id,
+                    "Devices": [dev.as_dict() for dev in self.devices.values()],
+                }
+            }
+        if name in ("Ping", "RequestLog"):
+            return ok
+        if name == "StartScanning":
+            self._scanning = True
+            self.scans += 1
+            if self.scan_duration:
+                if self._scan_timer is not None:
+                    self._scan_timer.cancel()
+                self._scan_timer = asyncio.get_running_loop().call_later(
+                    self.scan_duration, self._finish_scan
+                )
+            return ok
+        if name == "StopScanning":
+            if not self._scanning:
+                return self._error(
+                    msg_id,
+                    '{"ButtplugDeviceError":"DeviceScanningAlreadyStopped"}',
+                    ERROR_DEVICE,
+                )
+            self._scanning = False
+            if self._scan_timer is not None:
+                self._scan_timer.cancel()
+                self._scan_timer = None
+            return ok
+        if name == "StopAllDevices":
+            self._record(received, name, body)
+            return ok
+        if name in DEVICE_COMMANDS:
+            if body.get("DeviceIndex") not in self.devices:
+                return self._error(msg_id, "Device not found", ERROR_DEVICE)
+            self._record(received, name, body)
+            return ok
+        return self._error(msg_id, f"Unknown message {name}", ERROR_MSG)
+
+    def _finish_scan(self) -> None:
+        """End a scan on its own, like a server whose scan timed out."""
+        self._scan_timer = None
+        self._scanning = False
+        task = asyncio.create_task(self._broadcast({"ScanningFinished": {"Id": 0}}))
+        self._responses.add(task)
+        task.add_done_callback(self._responses.discard)
+
+    def _record(self, received: float, name: str, body: dict[str, Any]) -> None:
+        if self.record:
+            self.received.append(ReceivedCommand(received, name, body))
+
+    @staticmethod
+    def _error(msg_id: int, message: str, code: int) -> dict[str, Any]:
+        return {"Error": {"Id": msg_id, "ErrorMessage": message, "ErrorCode": code}}
+
+
+async def _serve(args: argparse.Namespace) -> None:
+    server = FakeButtplugServer(
+        device_count=args.devices,
+        message_delay=args.delay,
+        host=args.host,
+        port=args.port,
+        record=False,
+    )
+    await server.start()
+    print(f"Serving {args.devices} fake devices on {server.address}")
+    try:
+        await asyncio.Future()
+    finally:
+        await server.stop()
+
+
+def main() -> None:
+    """Run the fake server until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=3)
+    parser.add_argument("--delay", type=float, default=0.0, help="ack delay (s)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12345)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
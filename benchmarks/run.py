@@ -0,0 +1,270 @@
+"""Latency, throughput and setup benchmarks against the fake Buttplug server.
+
+Client benchmarks only need ``buttplug``. The integration benchmarks (entity to
+wire latency and config entry setup/unload) run the integration in a test Home
+Assistant instance and need ``pytest-homeassistant-custom-component``; they are
+skipped when it isn't installed.
+
+Run from the repository root with ``python -m benchmarks.run``.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+from collections.abc import Awaitable, Callable, Sequence
+import logging
+import time
+from typing import Any
+
+from buttplug.client import ButtplugClient, ButtplugClientWebsocketConnector
+
+from .fake_server import FakeButtplugServer
+
+DEVICE_COUNTS = (1, 10, 100)
+
+
+def percentiles(samples: Sequence[float]) -> str:
+    """Format p50/p95/p99/max of samples given in seconds as milliseconds."""
+    if not samples:
+        return "no samples"
+    ordered = sorted(samples)
+
+    def pick(fraction: float) -> float:
+        return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)] * 1000
+
+    return (
+        f"p50 {pick(0.5):7.2f} ms  p95 {pick(0.95):7.2f} ms  "
+        f"p99 {pick(0.99):7.2f} ms  max {ordered[-1] * 1000:7.2f} ms"
+    )
+
+
+async def measure_latency(
+    server: FakeButtplugServer,
+    send: Callable[[float], Awaitable[Any]],
+    count: int,
+) -> tuple[list[float], list[float]]:
+    """Send sequentially, returning (call-to-wire, call-to-return) latencies."""
+    wire: list[float] = []
+    done: list[float] = []
+    for i in range(count):
+        seen = len(server.received)
+        start = time.monotonic()
+        await send((i % 100) / 100)
+        done.append(time.monotonic() - start)
+        if len(server.received) > seen:
+            wire.append(server.received[seen].received - start)
+    return wire, done
+
+
+async def measure_throughput(
+    senders: Sequence[Callable[[float], Awaitable[Any]]], duration: float
+) -> float:
+    """Keep every sender busy for a while and return the commands per second."""
+    sent = 0
+    deadline = time.monotonic() + duration
+
+    async def run(send: Callable[[float], Awaitable[Any]]) -> None:
+        nonlocal sent
+        i = 0
+        while time.monotonic() < deadline:
+            await send((i % 100) / 100)
+            i += 1
+            sent += 1
+
+    start = time.monotonic()
+    await asyncio.gather(*(run(send) for send in senders))
+    return sent / (time.monotonic() - start)
+
+
+async def measure_stop_under_load(
+    server: FakeButtplugServer,
+    stop: Callable[[], Awaitable[Any]],
+    senders: Sequence[Callable[[float], Awaitable[Any]]],
+    count: int,
+) -> tuple[list[float], list[float]]:
+    """Stop while every sender is busy, returning (call-to-wire, call-to-return)."""
+    wire: list[float] = []
+    done: list[float] = []
+    running = True
+
+    async def run(send: Callable[[float], Awaitable[Any]]) -> None:
+        i = 0
+        while running:
+            await send((i % 100) / 100)
+            i += 1
+
+    tasks = [asyncio.create_task(run(send)) for send in senders]
+    await asyncio.sleep(0.2)
+    for _ in range(count):
+        seen = len(server.received)
+        start = time.monotonic()
+        await stop()
+        done.append(time.monotonic() - start)
+        for command in server.received[seen:]:
+            if command.name == "StopAllDevices":
+                wire.append(command.received - start)
+                break
+        await asyncio.sleep(0.05)
+    running = False
+    await asyncio.gather(*tasks)
+    return wire, done
+
+
+async def bench_client(args: argparse.Namespace) -> None:
+    """Benchmark the bare Buttplug client against the fake server."""
+    print("== Buttplug client ==")
+    for device_count in args.devices:
+        server = FakeButtplugServer(device_count, args.delay)
+        await server.start()
+        client = ButtplugClient("benchmark")
+        start = time.monotonic()
+        await client.connect(ButtplugClientWebsocketConnector(server.address))
+        connect_time = time.monotonic() - start
+        devices = list(client.devices.values())
+
+        async def vibrate(value: float, dev=devices[0]) -> None:
+            await dev.send_vibrate_cmd({0: value})
+
+        wire, done = await measure_latency(server, vibrate, args.commands)
+        rate = await measure_throughput(
+            [lambda value, dev=dev: dev.send_stop_device_cmd() for dev in devices],
+            args.duration,
+        )
+        start = time.monotonic()
+        await client.disconnect()
+        disconnect_time = time.monotonic() - start
+        await server.stop()
+        print(
+            f"{device_count:4d} devices: connect {connect_time * 1000:8.2f} ms, "
+            f"disconnect {disconnect_time * 1000:8.2f} ms, {rate:8.0f} cmd/s"
+        )
+        print(f"     to wire: {percentiles(wire)}")
+        print(f"     acked:   {percentiles(done)}")
+
+
+async def bench_integration(args: argparse.Namespace) -> None:
+    """Benchmark the integration running in a test Home Assistant instance."""
+    try:
+        # homeassistant.loader can't be imported before homeassistant.core.
+        import homeassistant.core  # pylint: disable=unused-import
+        from homeassistant import loader
+        from pytest_homeassistant_custom_component.common import (
+            MockConfigEntry,
+            async_test_home_assistant,
+        )
+    except ImportError as err:
+        print(f"== Integration: skipped, can't import the test harness: {err} ==")
+        return
+
+    from custom_components.buttplug.const import (
+        CONF_MIN_SEND_INTERVAL,
+        DOMAIN,
+        SERVICE_STOP_ALL,
+    )
+
+    print(f"== Integration (min send interval {args.min_send_interval} s) ==")
+    for device_count in args.devices:
+        server = FakeButtplugServer(device_count, args.delay)
+        await server.start()
+        expected = sum(
+            attrs["FeatureCount"]
+            for dev in server.devices.values()
+            for attrs in dev.messages.values()
+        )
+        hass = await async_test_home_assistant(asyncio.get_running_loop())
+        hass.data.pop(loader.DATA_CUSTOM_COMPONENTS)
+        entry = MockConfigEntry(
+            domain=DOMAIN,
+            version=2,
+            data={"name": "benchmark", "server": server.address},
+            options={CONF_MIN_SEND_INTERVAL: args.min_send_interval},
+        )
+        entry.add_to_hass(hass)
+
+        start = time.monotonic()
+        await hass.config_entries.async_setup(entry.entry_id)
+        while len(hass.states.async_entity_ids("number")) < expected:
+            await asyncio.sleep(0.001)
+        setup_time = time.monotonic() - start
+
+        component = hass.data["number"]
+        entities = [
+            component.get_entity(entity_id)
+            for entity_id in hass.states.async_entity_ids("number")
+        ]
+        vibrators = [
+            entity for entity in entities if entity.unique_id.endswith("vibrate_0")
+        ]
+        entity = vibrators[0]
+        # Let the identify pings of the freshly added devices finish.
+        await asyncio.sleep(1.5)
+        wire, done = await measure_latency(
+            server,
+            lambda value: entity.async_set_native_value(value * 100),
+            args.commands,
+        )
+        rate = await measure_throughput(
+            [
+                lambda value, entity=entity: entity.async_set_native_value(value * 100)
+                for entity in vibrators
+            ],
+            args.duration,
+        )
+        stop_wire, stop_done = await measure_stop_under_load(
+            server,
+            lambda: hass.services.async_call(DOMAIN, SERVICE_STOP_ALL, blocking=True),
+            [
+                lambda value, entity=entity: entity.async_set_native_value(value * 100)
+                for entity in vibrators
+            ],
+            args.stops,
+        )
+
+        start = time.monotonic()
+        await hass.config_entries.async_unload(entry.entry_id)
+        unload_time = time.monotonic() - start
+        await hass.async_stop(force=True)
+        await server.stop()
+        print(
+            f"{device_count:4d} devices: setup {setup_time * 1000:8.2f} ms, "
+            f"unload {unload_time * 1000:8.2f} ms, {rate:8.0f} sets/s"
+        )
+        print(f"     to wire: {percentiles(wire)}")
+        print(f"     set:     {percentiles(done)}")
+        print(f"     stop under load, to wire: {percentiles(stop_wire)}")
+        print(f"     stop under load, acked:   {percentiles(stop_done)}")
+
+
+async def async_main(args: argparse.Namespace) -> None:
+    """Run the selected benchmarks."""
+    if args.suite in ("all", "client"):
+        await bench_client(args)
+    if args.suite in ("all", "integration"):
+        await bench_integration(args)
+
+
+def main() -> None:
+    """Parse arguments and run the benchmarks."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "suite", nargs="?", choices=("all", "client", "integration"), default="all"
+    )
+    parser.add_argument("--devices", type=int, nargs="+", default=list(DEVICE_COUNTS))
+    parser.add_argument("--commands", type=int, default=200, help="latency samples")
+    parser.add_argument(
+        "--duration", type=float, default=2.0, help="throughput run time (s)"
+    )
+    parser.add_argument(
+        "--delay", type=float, default=0.0, help="simulated ack delay (s)"
+    )
+    parser.add_argument("--min-send-interval", type=float, default=0.0)
+    parser.add_argument(
+        "--stops", type=int, default=20, help="stop_all samples under load"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(async_main(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,20 @@
 from __future__ import annotations
 
 import asyncio
-from async_timeout import timeout
+from collections.abc import Awaitable
+import random
+import time
+from typing import Any
+
 from buttplug.client import (
     ButtplugClient,
     ButtplugClientConnectorError,
     ButtplugClientDevice,
-    ButtplugClientWebsocketConnector,
 )
 from buttplug.core.errors import ButtplugDeviceError, ButtplugHandshakeError
+from buttplug.core.messages import Ping, ServerInfo
 from homeassistant.components.number import DOMAIN as NUMBER_DOMAIN
+from homeassistant.components.sensor import DOMAIN as SENSOR_DOMAIN
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.const import EVENT_HOMEASSISTANT_STOP
 from homeassistant.core import Event, HomeAssistant, callback
@@ -18,72 +23,76 @@ from homeassistant.exceptions import ConfigEntryNotReady
 from homeassistant.helpers import device_registry
 from homeassistant.helpers.dispatcher import async_dispatcher_send
 from homeassistant.helpers.typing import ConfigType
-from websockets.exceptions import ConnectionClosedError
-
+from websockets.exceptions import ConnectionClosedError, WebSocketException
+
+from .command_queue import DeviceCommandQueue, async_stop_all_devices
+from .capability_cache import CachedDevice, CapabilityCache
+from .connection import (
+    ServerConnection,
+    async_handshake,
+    async_take_client,
+    keepalive_interval,
+)
 from .const import (
+    CONF_KEEPALIVE_INTERVAL,
+    CONF_STREAM_HOST,
+    CONF_STREAM_PORT,
+    CONF_WATCHDOG_TIMEOUT,
+    DATA_CAPABILITY_CACHE,
     DATA_CLIENT,
+    DATA_COMMAND_QUEUES,
+    DATA_CONNECTION,
+    DATA_DEVICE_INDEX,
+    DATA_STARTUP_TIMINGS,
+    DATA_STREAM,
+    DATA_WATCHDOG,
+    DATA_PING_SCHEDULER,
     DATA_PLATFORM_SETUP,
+    DEFAULT_KEEPALIVE_INTERVAL,
+    DEFAULT_STREAM_HOST,
+    DEFAULT_STREAM_PORT,
+    DEFAULT_WATCHDOG_TIMEOUT,
     DOMAIN,
     EVENT_DEVICE_ADDED_TO_REGISTRY,
     LOGGER,
 )
+from .device_batcher import DeviceBatcher
+from .device_index import DeviceIndex
+from .ping import PingScheduler
+from .scanning import ScanScheduler
+from .services import async_setup_services
+from .stream import async_start_stream
+from .watchdog import InactivityWatchdog
 
 # from homeassistant.helpers.aiohttp_client import async_get_clientsession
 
 
 # TODO device identifiers are being turned from a list with one string to lists of individual characters when the server is restarted via ui. need to see whether it happens on stop or start. With buttplug disabled, ui restart mangles the identifiers AND sets "disabled_by": "config_entry"
-# TODO make a scanning-finished handler that restarts the scanning.
 
 # TODO set appropriate log levels instead of all warning
 
-# TODO setup auto-reconnecting when the buttplug server is stopped and started
+PLATFORMS = [NUMBER_DOMAIN, SENSOR_DOMAIN]
 
-CONNECT_TIMEOUT = 10
-DATA_CLIENT_LISTEN_TASK = "client_listen_task"
+RECONNECT_MIN_DELAY = 0.1
+RECONNECT_MAX_DELAY = 30
+TEARDOWN_TIMEOUT = 5
+DATA_DEVICE_BATCHER = "device_batcher"
+DATA_RECONNECTING = "reconnecting"
+DATA_SETUP_STARTED = "setup_started"
 DATA_START_PLATFORM_TASK = "start_platform_task"
+DATA_UNSUBSCRIBE_DEVICES = "unsubscribe_devices"
 
 DATA_KEY_NAME = "name"
 DATA_KEY_SERVER = "server"
 
-BUTTPLUG_CMD_VIBRATE = "VibrateCmd"
-BUTTPLUG_CMD_ROTATE = "RotateCmd"
-BUTTPLUG_CMD_LINEAR = "LinearCmd"
-
 
 async def async_setup(hass: HomeAssistant, config: ConfigType) -> bool:
     """Set up the Buttplug component."""
     hass.data[DOMAIN] = {}
+    async_setup_services(hass)
     return True
 
 
-async def ping_buttplug(dev: ButtplugClientDevice) -> None:
-    """Ping device."""
-    allowed_messages = set(dev.allowed_messages.keys())
-    if BUTTPLUG_CMD_ROTATE in allowed_messages:
-        # Putting rotate first because it takes longer to activate
-        await dev.send_rotate_cmd((0.1, True))
-    if BUTTPLUG_CMD_LINEAR in allowed_messages:
-        await dev.send_linear_cmd((300, 0.1))
-    if BUTTPLUG_CMD_VIBRATE in allowed_messages:
-        await dev.send_vibrate_cmd(0.1)
-    await asyncio.sleep(0.3)
-    if BUTTPLUG_CMD_ROTATE in allowed_messages:
-        await dev.send_rotate_cmd((0.5, True))
-    if BUTTPLUG_CMD_LINEAR in allowed_messages:
-        await dev.send_linear_cmd((400, 0))
-    if BUTTPLUG_CMD_VIBRATE in allowed_messages:
-        await dev.send_vibrate_cmd(0.5)
-    await asyncio.sleep(0.1)
-    if BUTTPLUG_CMD_ROTATE in allowed_messages:
-        await dev.send_rotate_cmd((0.1, True))
-    if BUTTPLUG_CMD_LINEAR in allowed_messages:
-        await dev.send_linear_cmd((200, 0))
-    if BUTTPLUG_CMD_VIBRATE in allowed_messages:
-        await dev.send_vibrate_cmd(0.1)
-    await asyncio.sleep(0.3)
-    await dev.send_stop_device_cmd()
-
-
 @callback
 def register_device(
     hass: HomeAssistant,
@@ -112,58 +121,69 @@ def register_device(
     return device
 
 
-async def device_added(
+@callback
+def device_added(
     hass: HomeAssistant,
     entry: ConfigEntry,
     dev_reg: device_registry.DeviceRegistry,
     dev: ButtplugClientDevice,
 ) -> None:
     """Add device to registry."""
-    register_device(hass, entry, dev_reg, dev)
+    data = hass.data[DOMAIN][entry.entry_id]
+    device = register_device(hass, entry, dev_reg, dev)
+    device_index: DeviceIndex = data[DATA_DEVICE_INDEX]
+    device_index.add(dev._index, device.id)  # pylint: disable=protected-access
+    cache: CapabilityCache = data[DATA_CAPABILITY_CACHE]
+    cache.async_update(dev)
     LOGGER.warning("Device added: %s", dev.name)
-    if dev.name not in ["WeVibe Moxie", "WeVibe Chorus"]:
-        # Avoid pinging devices that have no real off button; they might vibrate while in storage.
-        # TODO turn this into a user-configurable whitelist.
-        hass.async_create_task(ping_buttplug(dev))
 
 
-async def device_disconnected(
+@callback
+def device_disconnected(
+    hass: HomeAssistant,
+    entry: ConfigEntry,
     dev_reg: device_registry.DeviceRegistry,
     dev_index: int,
-    client: ButtplugClient,
-    entry: ConfigEntry,
 ) -> None:
     """Disable disconnected device."""
-    await prune_devices(dev_reg, client, entry)
-    # dev_reg.async_update_device(
-    #     dev.name, disabled_by=device_registry.DeviceEntryDisabler.INTEGRATION
-    # )  # TODO use this when buttplug-py gives device object instead of int id.
-    # LOGGER.info("Device removed: %s", dev.name)
+    data = hass.data[DOMAIN][entry.entry_id]
+    device_index: DeviceIndex = data[DATA_DEVICE_INDEX]
+    if (device_id := device_index.remove(dev_index)) is None:
+        # Unknown, or another connected device still uses the registry entry.
+        return
+    if (device := dev_reg.async_get(device_id)) is None:
+        return
+    LOGGER.info("Device removed: %s", device.model)
+    if (queue := data.get(DATA_COMMAND_QUEUES, {}).get(device.model)) is not None:
+        queue.async_bind(None)
+    if device.disabled_by is None:
+        LOGGER.warning("Disabling disconnected device: %s", device.model)
+        dev_reg.async_update_device(
+            device.id,
+            disabled_by=device_registry.DeviceEntryDisabler.INTEGRATION,
+        )
 
 
-async def prune_devices(
-    dev_reg: device_registry.DeviceRegistry,
-    client: ButtplugClient,
+@callback
+def prune_devices(
+    hass: HomeAssistant,
     entry: ConfigEntry,
+    dev_reg: device_registry.DeviceRegistry,
 ) -> None:
-    """Disable missing devices."""
-
+    """Disable devices that didn't show up after (re)connecting."""
+    device_index: DeviceIndex = hass.data[DOMAIN][entry.entry_id][DATA_DEVICE_INDEX]
     known_devices = device_registry.async_entries_for_config_entry(
         dev_reg, entry.entry_id
     )
-    connected_devices = [
-        dev_reg.async_get_device({dev.name}) for dev in client.devices.values()
-    ]
 
     # Devices that are in the device registry but which are not connected can be disabled
     for device in known_devices:
-        if device not in connected_devices:
-            if device.disabled_by == None:
-                LOGGER.warning("Disabling disconnected device: %s", device.model)
-                dev_reg.async_update_device(
-                    device.id,
-                    disabled_by=device_registry.DeviceEntryDisabler.INTEGRATION,
-                )
+        if device.id not in device_index and device.disabled_by is None:
+            LOGGER.warning("Disabling disconnected device: %s", device.model)
+            dev_reg.async_update_device(
+                device.id,
+                disabled_by=device_registry.DeviceEntryDisabler.INTEGRATION,
+            )
 
 
 async def async_setup_entry(
@@ -173,14 +193,90 @@ async def async_setup_entry(
     """Set up Buttplug from a config entry."""
 
     # TODO use async_get_clientsession(hass). ButtplugClient would need to use aiohttp.ClientSession like in here https://github.com/home-assistant-libs/zwave-js-server-python/blob/master/zwave_js_server/client.py
-    client = ButtplugClient(entry.data[DATA_KEY_NAME])
+    if not async_collapse_duplicate(hass, entry):
+        return False
+
+    cache = CapabilityCache(hass, entry)
+    await cache.async_load()
+
+    started = time.monotonic()
+    connection = await async_get_connection(hass, entry, cache)
+    entry_hass_data: dict = hass.data[DOMAIN].setdefault(entry.entry_id, {})
+    entry_hass_data[DATA_CONNECTION] = connection
+    entry_hass_data[DATA_SETUP_STARTED] = started
+    entry_hass_data[DATA_CAPABILITY_CACHE] = cache
+    entry_hass_data[DATA_WATCHDOG] = InactivityWatchdog(
+        hass, entry.options.get(CONF_WATCHDOG_TIMEOUT, DEFAULT_WATCHDOG_TIMEOUT)
+    )
+    entry_hass_data[DATA_STARTUP_TIMINGS] = {"connect": time.monotonic() - started}
+
+    platform_task = hass.async_create_task(start_platforms(hass, entry, connection))
+    entry_hass_data[DATA_START_PLATFORM_TASK] = platform_task
+
+    entry.async_on_unload(entry.add_update_listener(async_update_options))
+
+    return True
+
+
+@callback
+def async_collapse_duplicate(hass: HomeAssistant, entry: ConfigEntry) -> bool:
+    """Remove an entry for a server that another entry already holds.
+
+    A server can only be added once, but entries from before that was enforced
+    may still repeat one; they can't register their entities anyway. The first
+    of them to be set up claims the server as its unique ID. Returns whether
+    the entry is to be set up.
+    """
+    if entry.unique_id is not None:
+        return True
+    address = entry.data[DATA_KEY_SERVER]
+    for other in hass.config_entries.async_entries(DOMAIN):
+        if other.unique_id == address:
+            LOGGER.warning(
+                "Removing %s: %s is already set up by %s",
+                entry.title,
+                address,
+                other.title,
+            )
+            hass.async_create_task(hass.config_entries.async_remove(entry.entry_id))
+            return False
+    hass.config_entries.async_update_entry(entry, unique_id=address)
+    return True
+
+
+async def async_get_connection(
+    hass: HomeAssistant, entry: ConfigEntry, cache: CapabilityCache
+) -> ServerConnection:
+    """Return a connection to the server of a config entry.
+
+    Takes over the client of the config flow if it just connected. A server
+    that can't be reached still gets a connection, which keeps trying in the
+    background, unless it would have no devices to start with: then
+    ConfigEntryNotReady is raised.
+    """
     address = entry.data[DATA_KEY_SERVER]
-    connector = ButtplugClientWebsocketConnector(address)
+    if handed_off := async_take_client(hass, address, entry.data[DATA_KEY_NAME]):
+        # Connected by the config flow just now.
+        return ServerConnection(address, *handed_off)
+    client = ButtplugClient(entry.data[DATA_KEY_NAME])
+    try:
+        info = await async_connect(client, address)
+    except ConfigEntryNotReady:
+        if not cache.devices:
+            raise
+        # Entities of known devices can still be created; the connection
+        # supervisor keeps trying to connect in the background.
+        LOGGER.warning(
+            "Could not connect to Buttplug Server; starting with cached devices"
+        )
+        return ServerConnection(address, client, None)
+    return ServerConnection(address, client, info)
+
 
-    # connect and throw error if connection failed
+async def async_connect(client: ButtplugClient, address: str) -> ServerInfo:
+    """Connect and throw error if connection failed."""
     try:
-        async with timeout(CONNECT_TIMEOUT):
-            await client.connect(connector)
+        info = await async_handshake(client, address)
     except ButtplugClientConnectorError as err:
         raise ConfigEntryNotReady(
             f"Could not connect to buttplug server, exiting: {err.message}"
@@ -196,50 +292,51 @@ async def async_setup_entry(
         raise ConfigEntryNotReady(
             "Unexpected Exception when trying to connect."
         ) from err
-    else:
-        LOGGER.warning("Connected to Buttplug Server")
+    LOGGER.warning("Connected to Buttplug Server")
+    return info
 
-    platform_task = hass.async_create_task(start_platforms(hass, entry, client))
-    hass.data[DOMAIN].setdefault(entry.entry_id, {})[
-        DATA_START_PLATFORM_TASK
-    ] = platform_task
 
-    return True
+async def async_update_options(hass: HomeAssistant, entry: ConfigEntry) -> None:
+    """Reload the config entry when its options change."""
+    await hass.config_entries.async_reload(entry.entry_id)
 
 
 async def start_platforms(
     hass: HomeAssistant,
     entry: ConfigEntry,
-    client: ButtplugClient,
+    connection: ServerConnection,
 ) -> None:
     """Start platforms and perform discovery."""
     entry_hass_data: dict = hass.data[DOMAIN].setdefault(entry.entry_id, {})
-    entry_hass_data[DATA_CLIENT] = client
+    entry_hass_data[DATA_CLIENT] = connection.client
     entry_hass_data[DATA_PLATFORM_SETUP] = {}
+    entry_hass_data[DATA_DEVICE_INDEX] = DeviceIndex()
 
     async def handle_ha_shutdown(event: Event) -> None:
         """Handle HA shutdown."""
         LOGGER.warning("Handle HA shutdown")
         await disconnect_client(hass, entry)
 
-    listen_task = hass.async_create_task(client_listen(hass, entry, client))
-    entry_hass_data[DATA_CLIENT_LISTEN_TASK] = listen_task
+    connection.listen_task = hass.async_create_task(
+        client_listen(hass, entry, connection)
+    )
     entry.async_on_unload(
         hass.bus.async_listen(EVENT_HOMEASSISTANT_STOP, handle_ha_shutdown)
     )
 
     LOGGER.warning("Connection to Buttplug Server initialized")
 
-    await setup_driver(hass, entry, client)
+    await setup_driver(hass, entry, connection)
 
 
 async def setup_driver(
     hass: HomeAssistant,
     entry: ConfigEntry,
-    client: ButtplugClient,
+    connection: ServerConnection,
 ) -> None:
     """Set up devices using the ready driver."""
     dev_reg = device_registry.async_get(hass)
+    client = connection.client
     entry_hass_data: dict = hass.data[DOMAIN].setdefault(entry.entry_id, {})
     platform_setup_tasks = entry_hass_data[DATA_PLATFORM_SETUP]
 
@@ -251,82 +348,376 @@ async def setup_driver(
             )
         await platform_setup_tasks[platform]
 
-    async def async_on_dev_added(dev: ButtplugClientDevice) -> None:
-        """Handle dev added event."""
-        await async_setup_platform(NUMBER_DOMAIN)
-        async_dispatcher_send(
-            hass, f"{DOMAIN}_{entry.entry_id}_add_{NUMBER_DOMAIN}", dev
+    async def async_on_devs_added(
+        devs: list[ButtplugClientDevice | CachedDevice],
+    ) -> None:
+        """Create the entities of new devices, in one batch per platform."""
+        ready: list[asyncio.Future[None]] = []
+        for platform in PLATFORMS:
+            await async_setup_platform(platform)
+            ready.append(future := hass.loop.create_future())
+            async_dispatcher_send(
+                hass, f"{DOMAIN}_{entry.entry_id}_add_{platform}", devs, future
+            )
+        await asyncio.gather(*ready)
+
+    @callback
+    def async_register_devices(devs: list[ButtplugClientDevice]) -> None:
+        """Register new devices in one pass and ping them."""
+        for dev in devs:
+            device_added(hass, entry, dev_reg, dev)
+        # Of the devices coming back after a reconnect, only those never seen
+        # before (e.g. when the server was down at startup) still need a ping.
+        pings.async_schedule(
+            devs, only_new=entry_hass_data.get(DATA_RECONNECTING, False)
         )
 
-    def device_added_handler(emitter, dev: ButtplugClientDevice) -> None:
-        hass.async_create_task(async_on_dev_added(dev))
-        hass.async_create_task(device_added(hass, entry, dev_reg, dev))
-
-    def device_removed_handler(emitter, dev: ButtplugClientDevice) -> None:
-        hass.async_create_task(device_disconnected(dev_reg, dev, client, entry))
-
-    known_devices = device_registry.async_entries_for_config_entry(
-        dev_reg, entry.entry_id
+    @callback
+    def async_devices_arrived(devs: list[ButtplugClientDevice]) -> None:
+        """Handle a batch of devices added by the server."""
+        # Skip devices that left again, or went with the connection, meanwhile.
+        devs = [
+            dev
+            for dev in devs
+            if client.devices.get(dev._index) is dev  # pylint: disable=protected-access
+        ]
+        if devs:
+            async_register_devices(devs)
+            hass.async_create_task(async_on_devs_added(devs))
+
+    pings = entry_hass_data[DATA_PING_SCHEDULER] = PingScheduler(
+        hass, entry, client, entry.options
+    )
+    batcher = entry_hass_data[DATA_DEVICE_BATCHER] = DeviceBatcher(
+        hass, async_devices_arrived
     )
 
-    # LOGGER.warning("%s", known_devices)
-    # LOGGER.warning("%s", [device.id for device in known_devices])
-    # LOGGER.warning("%s", [device.identifiers for device in known_devices])
-    for device in known_devices:
-        # Spent a long time trying to figure out what is mangling identifiers. This workaround is functional though.
-        dev_reg.async_update_device(device.id, new_identifiers={device.model})
+    def device_added_handler(emitter, dev: ButtplugClientDevice) -> None:
+        batcher.async_add(dev)
+
+    def device_removed_handler(emitter, dev_index: int) -> None:
+        device_disconnected(hass, entry, dev_reg, dev_index)
+
+    if port := entry.options.get(CONF_STREAM_PORT, DEFAULT_STREAM_PORT):
+        entry_hass_data[DATA_STREAM] = await async_start_stream(
+            hass,
+            entry,
+            client,
+            entry.options.get(CONF_STREAM_HOST, DEFAULT_STREAM_HOST),
+            port,
+        )
 
-    known_devices = device_registry.async_entries_for_config_entry(
-        dev_reg, entry.entry_id
-    )
+    timings: dict[str, float] = entry_hass_data[DATA_STARTUP_TIMINGS]
+    started = time.monotonic()
 
-    # LOGGER.warning("%s", known_devices)
-    # LOGGER.warning("%s", [device.id for device in known_devices])
-    # LOGGER.warning("%s", [device.identifiers for device in known_devices])
+    repair_identifiers(dev_reg, entry)
+    timings["repair_identifiers"] = time.monotonic() - started
 
     client.device_added_handler += device_added_handler
     client.device_removed_handler += device_removed_handler
 
-    for device in client.devices.values():
-        device_added_handler(None, device)
+    @callback
+    def async_unsubscribe_devices() -> None:
+        client.device_added_handler -= device_added_handler
+        client.device_removed_handler -= device_removed_handler
 
-    await prune_devices(dev_reg, client, entry)
+    entry_hass_data[DATA_UNSUBSCRIBE_DEVICES] = async_unsubscribe_devices
 
+    started = time.monotonic()
+    devs = list(client.devices.values())
+    if devs:
+        async_register_devices(devs)
+    timings["add_devices"] = time.monotonic() - started
 
-async def client_listen(
-    hass: HomeAssistant,
-    entry: ConfigEntry,
-    client: ButtplugClient,
+    if connection.connected:
+        # Without a connection every device would look disconnected.
+        started = time.monotonic()
+        prune_devices(hass, entry, dev_reg)
+        timings["prune_devices"] = time.monotonic() - started
+
+    # Entities of cached devices are created right away and stay unavailable
+    # until their device connects.
+    cache: CapabilityCache = entry_hass_data[DATA_CAPABILITY_CACHE]
+    started = time.monotonic()
+    await async_on_devs_added([*cache.devices, *devs])
+    timings["add_entities"] = time.monotonic() - started
+    timings["connect_to_ready"] = time.monotonic() - entry_hass_data[DATA_SETUP_STARTED]
+
+    LOGGER.debug("Startup phase timings (s): %s", timings)
+
+
+@callback
+def repair_identifiers(
+    dev_reg: device_registry.DeviceRegistry, entry: ConfigEntry
 ) -> None:
-    """Listen with the client."""
+    """Restore mangled device identifiers.
+
+    Only entries whose identifiers actually differ are written, all in one pass,
+    so an unchanged registry costs no updates or saves at startup.
+    """
+    for device in device_registry.async_entries_for_config_entry(
+        dev_reg, entry.entry_id
+    ):
+        # Spent a long time trying to figure out what is mangling identifiers. This workaround is functional though.
+        if device.identifiers != {device.model}:
+            LOGGER.debug("Repairing identifiers of %s", device.model)
+            dev_reg.async_update_device(device.id, new_identifiers={device.model})
 
-    await client.start_scanning()
 
-    should_reload = True
-    while should_reload:
+async def client_listen(
+    hass: HomeAssistant, entry: ConfigEntry, connection: ServerConnection
+) -> None:
+    """Supervise the connection: reconnect, keep it alive and scan."""
+    client = connection.client
+    scanner = connection.scanner = ScanScheduler(
+        hass, client, lambda: async_count_commands(hass, entry)
+    )
+
+    backoff = 0
+    while True:
         try:
-            await hass.async_create_task(
-                asyncio.sleep(7 * 24 * 60 * 60)
-            )  # TODO figure out a better way to do this
+            await asyncio.sleep(backoff)
+            backoff = 0
+            if not connection.connected:
+                await async_reconnect(hass, entry, connection)
+            scanner.async_start()
+            interval = keepalive_interval(
+                connection.info,
+                entry.options.get(CONF_KEEPALIVE_INTERVAL, DEFAULT_KEEPALIVE_INTERVAL),
+            )
+            keepalive = (
+                hass.async_create_task(async_keepalive(client, interval))
+                if interval
+                else None
+            )
+            # websockets' keepalive pings bound how long a dead connection can go
+            # unnoticed; a closed or reset one is noticed right away.
+            try:
+                await client.connector.ws.wait_closed()
+            finally:
+                if keepalive is not None:
+                    keepalive.cancel()
+                scanner.async_suspend()
+            LOGGER.warning("Disconnected from Buttplug Server. Reconnecting")
+            async_connection_lost(hass, entry, connection)
         except asyncio.CancelledError:
-            should_reload = False
-            # LOGGER.warning("WASCANCELLED")
+            scanner.async_shutdown()
+            return
         except Exception as err:  # pylint: disable=broad-except
             # We need to guard against unknown exceptions to not crash this task.
             LOGGER.exception("Unexpected exception: %s", err)
-            LOGGER.warning("Disconnected from server. Reloading integration")
-            hass.async_create_task(hass.config_entries.async_reload(entry.entry_id))
+            backoff = RECONNECT_MAX_DELAY
+
+
+async def async_keepalive(client: ButtplugClient, interval: float) -> None:
+    """Ping the server every interval, dropping the connection if it doesn't answer.
+
+    Each ping waits for its reply in a task of its own, which is never cancelled
+    (see DeviceCommandQueue). A ping left unanswered is failed when the
+    connection is dropped.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        ping = asyncio.ensure_future(
+            client._send_message_expect_ok(Ping())  # pylint: disable=protected-access
+        )
+        ping.add_done_callback(_consume_result)
+        try:
+            await asyncio.wait_for(asyncio.shield(ping), interval)
+        except asyncio.TimeoutError:
+            LOGGER.warning("Buttplug Server didn't answer a ping in %s s", interval)
+            async_force_close(client)
+            return
+        except Exception as err:  # pylint: disable=broad-except
+            # Most likely the connection went; the supervisor takes it from here.
+            LOGGER.debug("Ping failed: %s", err)
+            return
+
+
+@callback
+def async_count_commands(hass: HomeAssistant, entry: ConfigEntry) -> int:
+    """Return the commands sent so far to the devices of a config entry."""
+    queues: dict[str, DeviceCommandQueue] = hass.data[DOMAIN][entry.entry_id].get(
+        DATA_COMMAND_QUEUES, {}
+    )
+    return sum(queue.sent for queue in queues.values())
+
+
+@callback
+def async_connection_lost(
+    hass: HomeAssistant, entry: ConfigEntry, connection: ServerConnection
+) -> None:
+    """Fail outstanding requests and mark every device unavailable."""
+    connection.connected = False
+    async_fail_requests(connection.client)
+    connection.client.devices.clear()
+    hass.data[DOMAIN][entry.entry_id][DATA_DEVICE_INDEX].clear()
+
+    queues: dict[str, DeviceCommandQueue] = hass.data[DOMAIN][entry.entry_id].get(
+        DATA_COMMAND_QUEUES, {}
+    )
+    for queue in queues.values():
+        queue.async_bind(None)
+
+
+@callback
+def async_fail_requests(client: ButtplugClient) -> None:
+    """Fail the requests of the client still waiting for a reply."""
+    # Replies to these will never arrive; without this their senders wait forever.
+    # Forgetting them also keeps a late reply from being matched to a done future.
+    for future in client._msg_tasks.values():  # pylint: disable=protected-access
+        if not future.done():
+            future.set_exception(
+                ButtplugClientConnectorError("Connection to server lost")
+            )
+    client._msg_tasks.clear()  # pylint: disable=protected-access
+
+
+async def async_reconnect(
+    hass: HomeAssistant, entry: ConfigEntry, connection: ServerConnection
+) -> None:
+    """Reconnect the client with jittered exponential backoff."""
+    client, address = connection.client, connection.address
+    delay = RECONNECT_MIN_DELAY
+    while True:
+        await asyncio.sleep(delay * random.uniform(0.5, 1))
+        try:
+            connection.info = await async_handshake(client, address)
+        except (
+            ButtplugClientConnectorError,
+            ButtplugHandshakeError,
+            asyncio.TimeoutError,
+            OSError,
+            WebSocketException,
+        ) as err:
+            LOGGER.debug("Reconnecting to %s failed: %s", address, err)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            continue
+        break
+
+    connection.connected = True
+    data = hass.data[DOMAIN][entry.entry_id]
+    if (batcher := data.get(DATA_DEVICE_BATCHER)) is not None:
+        # Register the devices from the server's device list now, before
+        # pruning, and without pinging those that were pinged before.
+        data[DATA_RECONNECTING] = True
+        try:
+            batcher.async_flush()
+        finally:
+            data[DATA_RECONNECTING] = False
+
+    LOGGER.warning("Reconnected to Buttplug Server")
+    prune_devices(hass, entry, device_registry.async_get(hass))
 
 
 async def disconnect_client(hass: HomeAssistant, entry: ConfigEntry) -> None:
     """Disconnect client."""
-    # TODO this should be imported into config flow to simplify that.
     data = hass.data[DOMAIN][entry.entry_id]
-    client: ButtplugClient = data[DATA_CLIENT]
+    connection: ServerConnection = data[DATA_CONNECTION]
+    client = connection.client
+    started = time.monotonic()
+    deadline = started + TEARDOWN_TIMEOUT
+    timings: dict[str, float] = {}
 
     LOGGER.warning("Disconnecting Client...")
+    # Don't leave anything running once Home Assistant lets go of the devices.
+    if (unsubscribe := data.pop(DATA_UNSUBSCRIBE_DEVICES, None)) is not None:
+        unsubscribe()
+    data[DATA_WATCHDOG].async_shutdown()
+    if (batcher := data.get(DATA_DEVICE_BATCHER)) is not None:
+        batcher.async_shutdown()
+    if (pings := data.get(DATA_PING_SCHEDULER)) is not None:
+        pings.async_shutdown()
+    if (stream := data.get(DATA_STREAM)) is not None:
+        stream.close()
+    # A server that doesn't answer shouldn't use up the time for a clean close.
+    finished = await async_run_phase(
+        "stop_devices",
+        [async_stop_devices(hass, entry)],
+        started + TEARDOWN_TIMEOUT / 2,
+        timings,
+    )
+
+    # TODO handle other tasks and/or listeners as needed here
+    tasks: list[asyncio.Task] = [
+        data[DATA_START_PLATFORM_TASK],
+        *data.get(DATA_PLATFORM_SETUP, {}).values(),
+    ]
+    if connection.listen_task is not None:
+        tasks.append(connection.listen_task)
+    if connection.scanner is not None:
+        connection.scanner.async_shutdown()
+    for task in tasks:
+        task.cancel()
+    finished &= await async_run_phase(
+        "stop_scanning_and_tasks",
+        [
+            async_stop_scanning(client),
+            asyncio.wait(tasks),
+            *(
+                queue.async_shutdown()
+                for queue in data.get(DATA_COMMAND_QUEUES, {}).values()
+            ),
+        ],
+        deadline,
+        timings,
+    )
+
+    LOGGER.warning("About to call client.disconnect()")
+    finished &= await async_run_phase(
+        "disconnect", [async_disconnect(client)], deadline, timings
+    )
+    if not finished:
+        LOGGER.warning("Teardown ran over; closing the connection")
+        async_force_close(client)
+    LOGGER.info("Teardown phase timings (s): %s", timings)
+    LOGGER.warning("Disconnected from Buttplug Server")
+
+
+async def async_run_phase(
+    name: str,
+    aws: list[Awaitable[Any]],
+    deadline: float,
+    timings: dict[str, float],
+) -> bool:
+    """Run a teardown phase concurrently, returning whether it beat the deadline.
+
+    Steps that miss the deadline are left running rather than cancelled (see
+    DeviceCommandQueue); force closing the connection ends them instead.
+    """
+    started = time.monotonic()
+    budget = max(0, deadline - started)
+    steps = [asyncio.ensure_future(aw) for aw in aws]
+    done, pending = await asyncio.wait(steps, timeout=budget)
+    timings[name] = time.monotonic() - started
+    if pending:
+        LOGGER.warning("Teardown phase %s didn't finish in %.1f s", name, budget)
+    for step in done:
+        if not step.cancelled() and (err := step.exception()) is not None:
+            LOGGER.error("Error during %s: %s", name, err)
+    for step in pending:
+        step.add_done_callback(_consume_result)
+    return not pending
+
+
+def _consume_result(step: asyncio.Future) -> None:
+    """Retrieve the outcome of a teardown step that finished late."""
+    if not step.cancelled():
+        step.exception()
+
+
+async def async_stop_devices(hass: HomeAssistant, entry: ConfigEntry) -> None:
+    """Stop all devices, logging if that failed."""
+    if not await async_stop_all_devices(hass, entry):
+        LOGGER.warning("Could not stop all devices before disconnecting")
+
+
+async def async_stop_scanning(client: ButtplugClient) -> None:
+    """Stop scanning for devices."""
     try:
         await client.stop_scanning()
+    except ButtplugClientConnectorError:
+        LOGGER.warning("Not connected; device scanning was not started.")
     except ButtplugDeviceError as err:
         if (
             err.message.error_message
@@ -337,57 +728,52 @@ async def disconnect_client(hass: HomeAssistant, entry: ConfigEntry) -> None:
             raise
     except asyncio.CancelledError:
         LOGGER.warning("asyncio.CancelledError")
-    except asyncio.exceptions.CancelledError:
-        LOGGER.warning("asyncio.exceptions.CancelledError")
-    except asyncio.exceptions.CancelledError:
-        LOGGER.warning("asyncio.exceptions.CancelledError")
     except ConnectionClosedError:
         LOGGER.exception(
             "Failed to stop scanning; connection between Home Assistant and Buttplug server already closed."
         )
 
-    # TODO handle other tasks and/or listeners as needed here
-    listen_task: asyncio.Task = data[DATA_CLIENT_LISTEN_TASK]
-    platform_task: asyncio.Task = data[DATA_START_PLATFORM_TASK]
-    listen_task.cancel()
-    platform_task.cancel()
-    platform_setup_tasks = data.get(DATA_PLATFORM_SETUP, {}).values()
-    for task in platform_setup_tasks:
-        task.cancel()
-
-    await asyncio.gather(listen_task, platform_task, *platform_setup_tasks)
 
+async def async_disconnect(client: ButtplugClient) -> None:
+    """Disconnect from the server."""
     # TODO check what happens if already disconnected.
-
-    # TODO stop all devices? probably should.
-    LOGGER.warning("About to call client.disconnect()")
     try:
         await client.disconnect()
     except ConnectionClosedError:
         LOGGER.exception(
             "Failed to disconnect; connection between Home Assistant and Buttplug server already closed."
         )
-    LOGGER.warning("Disconnected from Buttplug Server")
+
+
+@callback
+def async_force_close(client: ButtplugClient) -> None:
+    """Fail outstanding requests and drop the connection without a handshake."""
+    async_fail_requests(client)
+    if client.connector is not None and client.connector.ws is not None:
+        client.connector.ws.transport.abort()
 
 
 async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     """Unload a config entry."""
     info = hass.data[DOMAIN][entry.entry_id]
 
-    tasks = []
-    for platform, task in info[DATA_PLATFORM_SETUP].items():
+    unloads = []
+    for platform, task in info.get(DATA_PLATFORM_SETUP, {}).items():
         if task.done():
-            tasks.append(
+            unloads.append(
                 hass.config_entries.async_forward_entry_unload(entry, platform)
             )
         else:
+            # Never finished setting up; disconnect_client waits for the task.
             task.cancel()
-            tasks.append(task)
 
-    unload_ok = all(await asyncio.gather(*tasks))
+    # Entities are removed while the client disconnects.
+    results = await asyncio.gather(*unloads, disconnect_client(hass, entry))
+    unload_ok = all(results[: len(unloads)])
 
-    if DATA_CLIENT_LISTEN_TASK in info:
-        await disconnect_client(hass, entry)
+    # A delayed save still pending would be lost with the cache.
+    if (cache := info.get(DATA_CAPABILITY_CACHE)) is not None:
+        await cache.async_flush()
 
     hass.data[DOMAIN].pop(entry.entry_id)
 
@@ -0,0 +1,81 @@
+"""Persisted cache of the capabilities of known Buttplug devices."""
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+
+from buttplug.client import ButtplugClientDevice
+from buttplug.core import MessageAttributes
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.storage import Store
+
+from .const import DOMAIN
+
+STORAGE_VERSION = 1
+SAVE_DELAY = 10  # seconds
+
+
+@dataclass
+class CachedDevice:
+    """Stand-in for a device that isn't connected, built from the cache.
+
+    Has the same name and allowed_messages as a ButtplugClientDevice, so entities
+    can be created from it before the device connects.
+    """
+
+    name: str
+    allowed_messages: dict[str, MessageAttributes] = field(default_factory=dict)
+
+
+class CapabilityCache:
+    """Command types and feature counts of every device seen by a config entry."""
+
+    def __init__(self, hass: HomeAssistant, entry: ConfigEntry) -> None:
+        """Initialize the cache."""
+        self._store: Store = Store(
+            hass, STORAGE_VERSION, f"{DOMAIN}.{entry.entry_id}.capabilities"
+        )
+        self._devices: dict[str, dict[str, int | None]] = {}
+        self._unsaved = False
+
+    @property
+    def devices(self) -> list[CachedDevice]:
+        """Return the cached devices."""
+        return [
+            CachedDevice(
+                name,
+                {
+                    message: MessageAttributes(feature_count)
+                    for message, feature_count in messages.items()
+                },
+            )
+            for name, messages in self._devices.items()
+        ]
+
+    async def async_load(self) -> None:
+        """Load the cache from storage."""
+        if (data := await self._store.async_load()) is not None:
+            self._devices = data["devices"]
+
+    @callback
+    def async_update(self, dev: ButtplugClientDevice) -> None:
+        """Record the capabilities of a connected device, saving if they changed."""
+        messages = {
+            message: getattr(attributes, "feature_count", None)
+            for message, attributes in dev.allowed_messages.items()
+        }
+        if self._devices.get(dev.name) == messages:
+            return
+        self._devices[dev.name] = messages
+        self._unsaved = True
+        self._store.async_delay_save(self._data_to_save, SAVE_DELAY)
+
+    async def async_flush(self) -> None:
+        """Save changes still waiting for the delayed save right away."""
+        if self._unsaved:
+            await self._store.async_save(self._data_to_save())
+
+    @callback
+    def _data_to_save(self) -> dict:
+        self._unsaved = False
+        return {"devices": self._devices}
@@ -0,0 +1,479 @@
+"""Outbound command queue for Buttplug devices."""
+from __future__ import annotations
+
+import asyncio
+from collections.abc import Callable, Coroutine
+import time
+from typing import TYPE_CHECKING, Any
+
+from buttplug.client import ButtplugClient, ButtplugClientDevice
+from buttplug.core.messages import StopAllDevices
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant, callback
+from websockets.exceptions import ConnectionClosedError
+
+from .const import (
+    CMD_TYPE_LINEAR,
+    CMD_TYPE_ROTATE,
+    CMD_TYPE_VIBRATE,
+    CONF_MIN_SEND_INTERVAL,
+    DATA_CLIENT,
+    DATA_COMMAND_QUEUES,
+    DATA_WATCHDOG,
+    DEFAULT_MIN_SEND_INTERVAL,
+    DOMAIN,
+    LOGGER,
+)
+from .rate_limiter import AdaptiveRateLimiter
+
+if TYPE_CHECKING:
+    from .watchdog import InactivityWatchdog
+
+# How long to wait for other features of a device to be set before sending, so
+# e.g. a scene setting several motors results in one message per command type.
+BATCH_WINDOW = 0.01  # seconds
+
+LINEAR_MOVE_DURATION = 1000  # ms
+
+# How long shutting a queue down waits for sends already on the wire.
+SHUTDOWN_DRAIN_TIMEOUT = 1  # seconds
+
+
+def make_payload(
+    cmd_type: str, value: float, duration: int = LINEAR_MOVE_DURATION
+) -> Any:
+    """Build the per-feature payload for a value on the internal scale."""
+    if cmd_type == CMD_TYPE_ROTATE:
+        # negative means opposite direction
+        return (abs(value), value >= 0)
+    if cmd_type == CMD_TYPE_LINEAR:
+        # move to the position over the duration (ms)
+        return (duration, value)
+    return value
+
+
+def payload_value(cmd_type: str, payload: Any) -> float:
+    """Return the value on the internal scale a payload was built from."""
+    if cmd_type == CMD_TYPE_ROTATE:
+        speed, clockwise = payload
+        return speed if clockwise else -speed
+    if cmd_type == CMD_TYPE_LINEAR:
+        return payload[1]
+    return payload
+
+
+class DeviceCommandQueue:
+    """Latest-value-wins outbound command queue for a single device.
+
+    Values that arrive while a command is in flight, or while the rate limiter
+    holds sends back, replace any older pending value for the same feature. Only
+    the newest value per feature is ever sent, so the device can't fall behind
+    its inputs. Pending values of the same command type are merged into a single
+    multi-index message.
+
+    Sends are never cancelled once they're on the wire: the buttplug client
+    can't cope with a request being cancelled while it awaits the reply. Values
+    are called off before they are sent instead, by halting the queue.
+    """
+
+    def __init__(
+        self,
+        hass: HomeAssistant,
+        dev: ButtplugClientDevice | None,
+        min_interval: float = DEFAULT_MIN_SEND_INTERVAL,
+        watchdog: InactivityWatchdog | None = None,
+    ) -> None:
+        """Initialize the queue."""
+        self.hass = hass
+        self.device = dev
+        self.min_interval = min_interval
+        self.watchdog = watchdog
+        self.last_command: float | None = None
+        self.sent = 0
+        self.limiter = AdaptiveRateLimiter(min_interval)
+        self._pending: dict[tuple[str, int], Any] = {}
+        self._sent_values: dict[tuple[str, int], float] = {}
+        self._waiters: dict[tuple[str, int], asyncio.Future[bool]] = {}
+        self._wakeup = asyncio.Event()
+        self._pending_since = 0.0
+        self._task: asyncio.Task | None = None
+        self._sending = asyncio.Lock()
+        self._stopping: asyncio.Task[bool] | None = None
+        self._in_flight: set[asyncio.Future[None]] = set()
+        self._motions: dict[tuple[str, int], asyncio.Task] = {}
+        self._listeners: list[Callable[[], None]] = []
+        self.stops = 0
+        self.stop_latency: float | None = None
+
+    @property
+    def available(self) -> bool:
+        """Return whether the device is connected."""
+        return self.device is not None
+
+    @property
+    def depth(self) -> int:
+        """Return the number of features with a pending value."""
+        return len(self._pending)
+
+    @callback
+    def async_add_listener(self, update_callback: Callable[[], None]) -> Callable:
+        """Listen for the device being bound, unbound or halted."""
+        self._listeners.append(update_callback)
+
+        @callback
+        def remove_listener() -> None:
+            self._listeners.remove(update_callback)
+
+        return remove_listener
+
+    @callback
+    def async_bind(self, dev: ButtplugClientDevice | None) -> None:
+        """Send to a new device object, or to nothing while it is disconnected.
+
+        Devices get a new object every time they are (re)added by the server.
+        Unbinding drops whatever was pending or playing for the old one.
+        """
+        if dev is None:
+            self.async_clear()
+        self.device = dev
+        self._forget_motors()
+        for update_callback in list(self._listeners):
+            update_callback()
+
+    @callback
+    def async_clear(self) -> None:
+        """Cancel timed sequences and drop pending values."""
+        self.last_command = None
+        self.async_cancel_motion()
+        self._pending.clear()
+        for future in self._waiters.values():
+            if not future.done():
+                future.set_result(False)
+        self._waiters.clear()
+
+    def last_value(self, cmd_type: str, index: int) -> float | None:
+        """Return the last value sent to a feature, on the internal scale."""
+        if (value := self._sent_values.get((cmd_type, index))) is None:
+            # Motors are stopped after a halt or (re)connect; positions unknown.
+            return None if cmd_type == CMD_TYPE_LINEAR else 0.0
+        return value
+
+    def _forget_motors(self) -> None:
+        """Forget the values of motors, which a halt or (re)connect stops."""
+        self._sent_values = {
+            key: value
+            for key, value in self._sent_values.items()
+            if key[0] == CMD_TYPE_LINEAR
+        }
+
+    @callback
+    def async_enqueue(
+        self, cmd_type: str, index: int, payload: Any, immediate: bool = False
+    ) -> asyncio.Future[bool]:
+        """Queue a value for a feature, replacing any pending one.
+
+        The returned future resolves to whether the newest value for the feature
+        was sent successfully; callers whose value got replaced share the future
+        of the value that replaced it. Immediate values skip the batch window and
+        only wait for the rate limiter.
+        """
+        key = (cmd_type, index)
+        if immediate:
+            self._pending_since = time.monotonic() - BATCH_WINDOW
+        elif not self._pending:
+            self._pending_since = time.monotonic()
+        self._pending[key] = payload
+        if (future := self._waiters.get(key)) is None:
+            future = self._waiters[key] = self.hass.loop.create_future()
+        if self._task is None:
+            self._task = self.hass.async_create_task(self._async_run())
+        self._wakeup.set()
+        return future
+
+    @callback
+    def async_start_motion(
+        self, cmd_type: str, index: int, target: Coroutine[Any, Any, None]
+    ) -> asyncio.Task:
+        """Run a timed sequence (e.g. a pattern) on a feature, replacing any other."""
+        key = (cmd_type, index)
+        self.async_cancel_motion(cmd_type, index)
+        task = self._motions[key] = self.hass.async_create_task(target)
+
+        @callback
+        def _async_motion_done(_: asyncio.Task) -> None:
+            if self._motions.get(key) is task:
+                del self._motions[key]
+
+        task.add_done_callback(_async_motion_done)
+        return task
+
+    @callback
+    def async_cancel_motion(
+        self, cmd_type: str | None = None, index: int | None = None
+    ) -> None:
+        """Cancel the timed sequence on a feature, or on all features if omitted."""
+        if cmd_type is None:
+            for task in self._motions.values():
+                task.cancel()
+            self._motions.clear()
+        elif (task := self._motions.pop((cmd_type, index), None)) is not None:
+            task.cancel()
+
+    @callback
+    def async_halt(self) -> None:
+        """Drop everything that is pending, playing or in progress for the device.
+
+        Sends that are already on the wire can't be recalled, but anything that
+        was about to be sent, including the rest of a flush or a ping, is not.
+        """
+        self.stops += 1
+        self.async_clear()
+        self._forget_motors()
+        for update_callback in list(self._listeners):
+            update_callback()
+
+    async def async_stop(self) -> bool:
+        """Stop the device ahead of anything queued for it.
+
+        The stop is sent right away, skipping the queue and the rate limiter, so
+        it only waits for its own round trip. Stops asked for while one is on its
+        way, e.g. for several entities of the device, share it. Returns whether
+        it was acknowledged.
+        """
+        self.async_halt()
+        if self._stopping is None:
+            if self.device is None:
+                return False
+            self._stopping = self.hass.async_create_task(
+                self._async_send_stop(self.device)
+            )
+            self._stopping.add_done_callback(self._async_stop_done)
+        return await asyncio.shield(self._stopping)
+
+    async def _async_send_stop(self, dev: ButtplugClientDevice) -> bool:
+        """Send a StopDeviceCmd, timing its round trip."""
+        started = time.monotonic()
+        try:
+            await dev.send_stop_device_cmd()
+        except Exception as err:  # pylint: disable=broad-except
+            LOGGER.error("Failed to stop %s: %s", dev.name, err)
+            return False
+        self.stop_latency = time.monotonic() - started
+        LOGGER.debug("Stopped %s in %.2f ms", dev.name, self.stop_latency * 1000)
+        return True
+
+    @callback
+    def _async_stop_done(self, _: asyncio.Task[bool]) -> None:
+        self._stopping = None
+
+    async def _async_run(self) -> None:
+        """Send pending values, honouring the batch window and send interval."""
+        while True:
+            await self._wakeup.wait()
+            while self._pending:
+                now = time.monotonic()
+                delay = max(
+                    self.limiter.delay(now),
+                    self._pending_since + BATCH_WINDOW - now,
+                )
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue  # pending values may have changed while sleeping
+                await self._async_flush()
+            self._wakeup.clear()
+
+    async def _async_flush(self) -> None:
+        """Send all pending values, one message per command type."""
+        async with self._sending:
+            batches: dict[str, dict[int, Any]] = {}
+            for (cmd_type, index), payload in self._pending.items():
+                batches.setdefault(cmd_type, {})[index] = payload
+            waiters = self._waiters
+            self._pending = {}
+            self._waiters = {}
+            stops = self.stops
+            try:
+                for cmd_type, payloads in batches.items():
+                    result = await self._async_send_paced(cmd_type, payloads, stops)
+                    for index in payloads:
+                        if not (future := waiters[(cmd_type, index)]).done():
+                            future.set_result(result)
+            finally:
+                # Don't leave callers hanging if the flush gets cancelled.
+                for future in waiters.values():
+                    if not future.done():
+                        future.set_result(False)
+
+    async def async_send_now(
+        self,
+        batches: dict[str, dict[int, Any]],
+        dispatched: list[float] | None = None,
+    ) -> bool:
+        """Send values right away, one message per command type.
+
+        Skips the batch window and the wait for the rate limiter, for callers that
+        need several devices to start at the same moment. Values pending for the
+        same features are superseded and timed sequences on them are cancelled.
+        A flush already sending goes first, so it can't overtake these values.
+        The moment the messages go out is appended to dispatched, if given.
+        Returns whether every message was sent.
+        """
+        stops = self.stops
+        superseded: list[asyncio.Future[bool]] = []
+        for cmd_type, payloads in batches.items():
+            for index in payloads:
+                self.async_cancel_motion(cmd_type, index)
+                if self._pending.pop((cmd_type, index), None) is not None:
+                    superseded.append(self._waiters.pop((cmd_type, index)))
+        async with self._sending:
+            if dispatched is not None:
+                dispatched.append(time.monotonic())
+            results = await asyncio.gather(
+                *(
+                    self._async_send_paced(cmd_type, payloads, stops)
+                    for cmd_type, payloads in batches.items()
+                )
+            )
+        for future in superseded:
+            if not future.done():
+                future.set_result(all(results))
+        return all(results)
+
+    async def _async_send_paced(
+        self, cmd_type: str, payloads: dict[int, Any], stops: int
+    ) -> bool:
+        """Send a message, feeding its round-trip time to the rate limiter.
+
+        Nothing is sent if the device was stopped since the values were taken.
+        """
+        if self.stops != stops:
+            return False
+        self.limiter.acquire()
+        started = time.monotonic()
+        result = await self._async_send(cmd_type, payloads)
+        if self.device is not None:
+            self.limiter.record(time.monotonic() - started if result else None)
+        if result:
+            self.last_command = time.monotonic()
+            self.sent += 1
+            for index, payload in payloads.items():
+                self._sent_values[(cmd_type, index)] = payload_value(cmd_type, payload)
+            if self.watchdog is not None:
+                self.watchdog.async_touch(self)
+        return result
+
+    async def _async_send(self, cmd_type: str, payloads: dict[int, Any]) -> bool:
+        """Send the values for several features of one command type at once."""
+        if (dev := self.device) is None:
+            return False
+        if cmd_type == CMD_TYPE_VIBRATE:
+            request = dev.send_vibrate_cmd(payloads)
+        elif cmd_type == CMD_TYPE_ROTATE:
+            request = dev.send_rotate_cmd(payloads)
+        elif cmd_type == CMD_TYPE_LINEAR:
+            request = dev.send_linear_cmd(payloads)
+        else:
+            return False
+        send = asyncio.ensure_future(request)
+        self._in_flight.add(send)
+        send.add_done_callback(self._async_send_done)
+        try:
+            # Whoever awaits the send may be cancelled; the request itself isn't.
+            await asyncio.shield(send)
+        except ConnectionClosedError:
+            # The connection supervisor notices this on its own and reconnects.
+            LOGGER.warning(
+                "Failed to send command to %s; connection between Home Assistant and Buttplug server already closed.",
+                dev.name,
+            )
+        except Exception as err:  # pylint: disable=broad-except
+            LOGGER.exception(
+                "Exception while sending %s (%s) command to %s: %s",
+                cmd_type,
+                payloads,
+                dev.name,
+                err,
+            )
+        else:
+            return True
+        return False
+
+    @callback
+    def _async_send_done(self, send: asyncio.Future[None]) -> None:
+        self._in_flight.discard(send)
+        if not send.cancelled():
+            # Retrieved here too in case whoever awaited it was cancelled.
+            send.exception()
+
+    async def async_shutdown(self) -> None:
+        """Stop the sender and any timed sequences, and drop pending values.
+
+        Sends on the wire get up to SHUTDOWN_DRAIN_TIMEOUT to finish before the
+        sender is cancelled; the rest of a flush is called off right away.
+        """
+        self.stops += 1
+        self.async_clear()
+        if self._in_flight:
+            await asyncio.wait(self._in_flight, timeout=SHUTDOWN_DRAIN_TIMEOUT)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+@callback
+def async_get_command_queue(
+    hass: HomeAssistant,
+    entry: ConfigEntry,
+    name: str,
+    dev: ButtplugClientDevice | None = None,
+) -> DeviceCommandQueue:
+    """Get the command queue for a device, creating it if needed.
+
+    The queue is bound to dev if given; otherwise a new queue stays unbound
+    until its device connects.
+    """
+    data = hass.data[DOMAIN][entry.entry_id]
+    queues: dict[str, DeviceCommandQueue] = data.setdefault(DATA_COMMAND_QUEUES, {})
+    if (queue := queues.get(name)) is None:
+        queue = queues[name] = DeviceCommandQueue(
+            hass,
+            dev,
+            entry.options.get(CONF_MIN_SEND_INTERVAL, DEFAULT_MIN_SEND_INTERVAL),
+            data.get(DATA_WATCHDOG),
+        )
+    elif dev is not None and queue.device is not dev:
+        queue.async_bind(dev)
+    return queue
+
+
+async def async_stop_all_devices(hass: HomeAssistant, entry: ConfigEntry) -> bool:
+    """Stop every device of a config entry with a single StopAllDevices message.
+
+    All command queues are halted first, so nothing queued can follow the stop.
+    Returns whether the server acknowledged it.
+    """
+    data = hass.data[DOMAIN][entry.entry_id]
+    queues: dict[str, DeviceCommandQueue] = data.get(DATA_COMMAND_QUEUES, {})
+    for queue in queues.values():
+        queue.async_halt()
+    client: ButtplugClient | None = data.get(DATA_CLIENT)
+    if client is None or client.connector is None or not client.connector.connected:
+        return False
+    started = time.monotonic()
+    try:
+        # The client has no public way to stop all devices.
+        await client._send_message_expect_ok(  # pylint: disable=protected-access
+            StopAllDevices()
+        )
+    except Exception as err:  # pylint: disable=broad-except
+        LOGGER.error("Failed to stop all devices: %s", err)
+        return False
+    latency = time.monotonic() - started
+    for queue in queues.values():
+        queue.stop_latency = latency
+    LOGGER.debug("Stopped all devices in %.2f ms", latency * 1000)
+    return True
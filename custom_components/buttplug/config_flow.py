@@ -1,86 +1,79 @@
 """Config flow for Buttplug integration."""
 from __future__ import annotations
 
+import asyncio
+
 import voluptuous as vol
-from buttplug.client import (
-    ButtplugClient,
-    ButtplugClientConnectorError,
-    ButtplugClientWebsocketConnector,
-)
+from buttplug.client import ButtplugClient, ButtplugClientConnectorError
 from buttplug.core.errors import ButtplugHandshakeError
+from buttplug.core.messages import ServerInfo
 from homeassistant import config_entries
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
 from homeassistant.data_entry_flow import FlowResult
 from homeassistant.exceptions import HomeAssistantError
+from homeassistant.helpers import config_validation as cv, device_registry
 from typing import Any
+from websockets.exceptions import WebSocketException
 
-from .const import DEFAULT_NAME, DEFAULT_SERVER, DOMAIN, LOGGER
+from .connection import async_hand_off_client, async_handshake
+from .const import (
+    CONF_KEEPALIVE_INTERVAL,
+    CONF_MIN_SEND_INTERVAL,
+    CONF_PING_CONCURRENCY,
+    CONF_PING_EXCLUDE,
+    CONF_PING_INCLUDE,
+    CONF_PING_PATTERN,
+    CONF_STATE_WRITE_INTERVAL,
+    CONF_STREAM_HOST,
+    CONF_STREAM_PORT,
+    CONF_WATCHDOG_TIMEOUT,
+    DEFAULT_KEEPALIVE_INTERVAL,
+    DEFAULT_MIN_SEND_INTERVAL,
+    DEFAULT_PING_CONCURRENCY,
+    DEFAULT_PING_EXCLUDE,
+    DEFAULT_PING_PATTERN,
+    DEFAULT_STATE_WRITE_INTERVAL,
+    DEFAULT_STREAM_HOST,
+    DEFAULT_STREAM_PORT,
+    DEFAULT_WATCHDOG_TIMEOUT,
+    DEFAULT_NAME,
+    DEFAULT_SERVER,
+    DOMAIN,
+    LOGGER,
+    PING_PATTERNS,
+)
 
 STEP_USER_DATA_SCHEMA = vol.Schema({
     vol.Required("name", default=DEFAULT_NAME): str,
     vol.Required("server", default=DEFAULT_SERVER): str
 })
 
-# TODO https://buttplug-developer-guide.docs.buttplug.io/cookbook/connector-setup-in-depth.html#buttplug-ping when supported
-
-
-class PlaceholderHub:
-    """Placeholder class to make tests pass.
-
-    TODO Remove this placeholder class and replace with things from your PyPI package.
-    """
-
-    def __init__(self, name: str, address: str) -> None:
-        """Initialize."""
-        self.name = name
-        self.address = address
-
-    async def authenticate(self) -> bool:
-        """Test if we can authenticate with the host."""
-        return True
-        client = ButtplugClient(self.name)
-        connector = ButtplugClientWebsocketConnector(self.address)
-        # TODO should add listeners?
-        # TODO make it clear what the exact address being used is in the errors.
-        try:
-            await client.connect(connector)
-        except ButtplugClientConnectorError as error:
-            raise CannotConnect(
-                f"Could not connect to buttplug server, exiting: {error.message}"
-            ) from error
-        except ButtplugHandshakeError as error:
-            raise CannotConnect(
-                f"Handshake with buttplug server failed, exiting: {error.message}"
-            ) from error
-        except Exception as error:
-            LOGGER.exception("Unexpected exception")
-            raise CannotConnect(
-                "Unexpected Exception when trying to connect."
-            ) from error
-        return True
 
-
-async def validate_input(hass: HomeAssistant, data: dict[str, Any]) -> dict[str, Any]:
+async def validate_input(
+    hass: HomeAssistant, data: dict[str, Any]
+) -> tuple[ButtplugClient, ServerInfo]:
     """Validate the user input allows us to connect.
 
     Data has the keys from STEP_USER_DATA_SCHEMA with values provided by the user.
+    Returns the connected client and what the server told about itself.
     """
-    # TODO validate the data can be used to set up a connection.
-
-    # If your PyPI package is not built with async, pass your methods
-    # to the executor:
-    # await hass.async_add_executor_job(
-    #     your_validate_func, data["name"], address
-    # )
-    # TODO check if buttplug is built with async as described above.
-    # TODO possible to use existing websocket thing that would handle the lifecycle of the connection for me?
-
-    hub = PlaceholderHub(data["name"], data["server"])
-
-    if not await hub.authenticate():
-        raise CannotConnect
-
-    return {"title": f"Buttplug ({data['name']})"}
+    client = ButtplugClient(data["name"])
+    try:
+        info = await async_handshake(client, data["server"])
+    except ButtplugHandshakeError as error:
+        raise InvalidHandshake(
+            f"Handshake with {data['server']} failed: {error.message}"
+        ) from error
+    except (
+        ButtplugClientConnectorError,
+        asyncio.TimeoutError,
+        OSError,
+        WebSocketException,
+    ) as error:
+        raise CannotConnect(
+            f"Could not connect to {data['server']}: {error}"
+        ) from error
+    return client, info
 
 
 class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
@@ -88,6 +81,12 @@ class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
 
     VERSION = 2
 
+    def __init__(self) -> None:
+        """Initialize the flow."""
+        self._data: dict[str, Any] = {}
+        self._client: ButtplugClient | None = None
+        self._info: ServerInfo | None = None
+
     async def async_step_user(
         self, user_input: dict[str, Any] | None = None
     ) -> FlowResult:
@@ -96,36 +95,168 @@ class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
             return self.async_show_form(
                 step_id="user", data_schema=STEP_USER_DATA_SCHEMA
             )
-        # await self.async_set_unique_id(user_input["address"]) # TODO when is user_input None? this would block addition of another instance. TODO need to use something else; per guidelines https://developers.home-assistant.io/docs/config_entries_config_flow_handler#example-acceptable-sources-for-a-unique-id
-        # self._abort_if_unique_id_configured()
+        # A server can only be added once. Entries made before unique IDs were
+        # set are matched on the address.
+        await self.async_set_unique_id(user_input["server"])
+        self._abort_if_unique_id_configured()
+        self._async_abort_entries_match({"server": user_input["server"]})
         # TODO add basic auth stuff? does it work with the port/websocket?
 
         errors = {}
 
         try:
-            info = await validate_input(self.hass, user_input)
-        except CannotConnect:
+            self._client, self._info = await validate_input(self.hass, user_input)
+        except CannotConnect as error:
+            LOGGER.info(error)
             errors["base"] = "cannot_connect"
+        except InvalidHandshake as error:
+            LOGGER.info(error)
+            errors["base"] = "invalid_handshake"
         except Exception:  # pylint: disable=broad-except
             LOGGER.exception("Unexpected exception")
             errors["base"] = "unknown"
         else:
-            return self.async_create_entry(title=info["title"], data=user_input)
+            self._data = user_input
+            return await self.async_step_confirm()
 
         return self.async_show_form(
             step_id="user", data_schema=STEP_USER_DATA_SCHEMA, errors=errors
         )
 
+    async def async_step_confirm(
+        self, user_input: dict[str, Any] | None = None
+    ) -> FlowResult:
+        """Show what was found on the server before adding it."""
+        assert self._client is not None and self._info is not None
+        if user_input is None:
+            return self.async_show_form(
+                step_id="confirm",
+                description_placeholders={
+                    "server_name": self._info.server_name,
+                    "device_count": str(len(self._client.devices)),
+                },
+            )
+        # The new config entry takes over the connection instead of connecting
+        # and handshaking all over again.
+        async_hand_off_client(self.hass, self._data["server"], self._client, self._info)
+        self._client = None
+        return self.async_create_entry(
+            title=f"Buttplug ({self._data['name']})", data=self._data
+        )
+
+    @callback
+    def async_remove(self) -> None:
+        """Disconnect a client that wasn't handed off when the flow goes away."""
+        if self._client is not None:
+            self.hass.async_create_task(self._client.disconnect())
+            self._client = None
+
+    @staticmethod
+    @callback
+    def async_get_options_flow(
+        config_entry: config_entries.ConfigEntry,
+    ) -> config_entries.OptionsFlow:
+        """Get the options flow for this handler."""
+        return OptionsFlowHandler(config_entry)
+
+
+class OptionsFlowHandler(config_entries.OptionsFlow):
+    """Handle Buttplug options."""
+
+    def __init__(self, config_entry: config_entries.ConfigEntry) -> None:
+        """Initialize options flow."""
+        self.config_entry = config_entry
+
+    async def async_step_init(
+        self, user_input: dict[str, Any] | None = None
+    ) -> FlowResult:
+        """Manage the options."""
+        if user_input is not None:
+            return self.async_create_entry(title="", data=user_input)
+
+        options = self.config_entry.options
+        include = options.get(CONF_PING_INCLUDE, [])
+        exclude = options.get(CONF_PING_EXCLUDE, DEFAULT_PING_EXCLUDE)
+        # Offer every device seen so far, plus whatever is already listed.
+        dev_reg = device_registry.async_get(self.hass)
+        names = sorted(
+            {
+                device.model
+                for device in device_registry.async_entries_for_config_entry(
+                    dev_reg, self.config_entry.entry_id
+                )
+                if device.model
+            }.union(include, exclude)
+        )
+        return self.async_show_form(
+            step_id="init",
+            data_schema=vol.Schema(
+                {
+                    vol.Required(
+                        CONF_MIN_SEND_INTERVAL,
+                        default=options.get(
+                            CONF_MIN_SEND_INTERVAL, DEFAULT_MIN_SEND_INTERVAL
+                        ),
+                    ): vol.All(vol.Coerce(float), vol.Range(min=0, max=5)),
+                    vol.Required(
+                        CONF_STATE_WRITE_INTERVAL,
+                        default=options.get(
+                            CONF_STATE_WRITE_INTERVAL, DEFAULT_STATE_WRITE_INTERVAL
+                        ),
+                    ): vol.All(vol.Coerce(float), vol.Range(min=0, max=60)),
+                    vol.Required(
+                        CONF_WATCHDOG_TIMEOUT,
+                        default=options.get(
+                            CONF_WATCHDOG_TIMEOUT, DEFAULT_WATCHDOG_TIMEOUT
+                        ),
+                    ): vol.All(vol.Coerce(float), vol.Range(min=0, max=86400)),
+                    vol.Required(
+                        CONF_KEEPALIVE_INTERVAL,
+                        default=options.get(
+                            CONF_KEEPALIVE_INTERVAL, DEFAULT_KEEPALIVE_INTERVAL
+                        ),
+                    ): vol.All(vol.Coerce(float), vol.Range(min=0, max=3600)),
+                    vol.Required(
+                        CONF_PING_PATTERN,
+                        default=options.get(CONF_PING_PATTERN, DEFAULT_PING_PATTERN),
+                    ): vol.In(PING_PATTERNS),
+                    vol.Required(CONF_PING_INCLUDE, default=include): cv.multi_select(
+                        names
+                    ),
+                    vol.Required(CONF_PING_EXCLUDE, default=exclude): cv.multi_select(
+                        names
+                    ),
+                    vol.Required(
+                        CONF_PING_CONCURRENCY,
+                        default=options.get(
+                            CONF_PING_CONCURRENCY, DEFAULT_PING_CONCURRENCY
+                        ),
+                    ): vol.All(vol.Coerce(int), vol.Range(min=1, max=10)),
+                    vol.Required(
+                        CONF_STREAM_PORT,
+                        default=options.get(CONF_STREAM_PORT, DEFAULT_STREAM_PORT),
+                    ): vol.All(vol.Coerce(int), vol.Range(min=0, max=65535)),
+                    vol.Required(
+                        CONF_STREAM_HOST,
+                        default=options.get(CONF_STREAM_HOST, DEFAULT_STREAM_HOST),
+                    ): cv.string,
+                }
+            ),
+        )
+
 
 class CannotConnect(HomeAssistantError):
     """Error to indicate we cannot connect."""
 
 
+class InvalidHandshake(HomeAssistantError):
+    """Error to indicate the server refused the handshake."""
+
+
 class InvalidAuth(HomeAssistantError):
     """Error to indicate there is invalid auth."""
 
 
 # TODO add quality_scale, supported_brands, dependencies, and after_dependencies to manifest.json?
 # TODO add translations?
-# TODO support https://developers.home-assistant.io/docs/config_entries_options_flow_handler
 # TODO unique ID? can get mac of bluetooth adapter? wouldn't be totally unique.
@@ -0,0 +1,129 @@
+"""Connecting to Buttplug servers."""
+from __future__ import annotations
+
+import asyncio
+
+from async_timeout import timeout
+from buttplug.client import ButtplugClient, ButtplugClientWebsocketConnector
+from buttplug.core.messages import (
+    DeviceList,
+    RequestDeviceList,
+    RequestServerInfo,
+    ServerInfo,
+)
+from homeassistant.core import HomeAssistant, callback
+from websockets.protocol import State
+
+from .const import DOMAIN, LOGGER
+from .scanning import ScanScheduler
+
+CONNECT_TIMEOUT = 10  # seconds
+# How long a client connected by the config flow waits for its config entry.
+HANDOFF_TIMEOUT = 60  # seconds
+
+# Not per config entry: hass.data key of clients connected by the config flow.
+DATA_FLOW_CLIENTS = f"{DOMAIN}_flow_clients"
+
+
+class ServerConnection:
+    """A config entry's client, connected to its server or trying to be."""
+
+    def __init__(
+        self, address: str, client: ButtplugClient, info: ServerInfo | None
+    ) -> None:
+        """Initialize the connection; info is None if not connected yet."""
+        self.address = address
+        self.client = client
+        self.info = info
+        self.connected = info is not None
+        self.listen_task: asyncio.Task | None = None
+        self.scanner: ScanScheduler | None = None
+
+
+async def async_handshake(client: ButtplugClient, address: str) -> ServerInfo:
+    """Connect a client and handshake within CONNECT_TIMEOUT.
+
+    Does what ButtplugClient.connect does, but keeps the server info that it
+    throws away: the server name and how often the server needs to be pinged.
+    """
+    connector = ButtplugClientWebsocketConnector(address)
+    client.connector = connector
+    connector.add_observer(client)
+    # pylint: disable=protected-access
+    async with timeout(CONNECT_TIMEOUT):
+        await connector.connect()
+        try:
+            info = await client._send_message_expect_reply(
+                RequestServerInfo(client.name), ServerInfo
+            )
+            device_list = await client._send_message_expect_reply(
+                RequestDeviceList(), DeviceList
+            )
+        except BaseException:
+            # Closing ends the read loop, so no late reply reaches the client.
+            await connector.disconnect()
+            raise
+    client._handle_device_list(device_list)
+    LOGGER.debug("Connected to %s at %s", info.server_name, address)
+    return info
+
+
+def keepalive_interval(info: ServerInfo | None, interval: float) -> float | None:
+    """Return how often to ping the server, or None not to ping at all.
+
+    Servers with a maximum ping time drop clients that don't ping within it, so
+    they are pinged at twice that rate, or more often if configured.
+    """
+    intervals = [interval] if interval > 0 else []
+    if info is not None and info.max_ping_time > 0:
+        intervals.append(info.max_ping_time / 1000 / 2)
+    return min(intervals, default=None)
+
+
+@callback
+def async_hand_off_client(
+    hass: HomeAssistant, address: str, client: ButtplugClient, info: ServerInfo
+) -> None:
+    """Keep a client connected by the config flow for the entry being created."""
+    clients: dict[str, tuple[ButtplugClient, ServerInfo, asyncio.TimerHandle]] = (
+        hass.data.setdefault(DATA_FLOW_CLIENTS, {})
+    )
+    if (replaced := clients.pop(address, None)) is not None:
+        replaced[2].cancel()
+        hass.async_create_task(replaced[0].disconnect())
+
+    @callback
+    def _async_expire() -> None:
+        del clients[address]
+        hass.async_create_task(client.disconnect())
+
+    clients[address] = (
+        client,
+        info,
+        hass.loop.call_later(HANDOFF_TIMEOUT, _async_expire),
+    )
+
+
+@callback
+def async_take_client(
+    hass: HomeAssistant, address: str, name: str
+) -> tuple[ButtplugClient, ServerInfo] | None:
+    """Take over the client the config flow connected to a server, if any.
+
+    Saves the config entry a second connect and handshake right after the flow.
+    """
+    handed_off = hass.data.get(DATA_FLOW_CLIENTS, {}).pop(address, None)
+    if handed_off is None:
+        return None
+    client, info, expiry = handed_off
+    expiry.cancel()
+    connector = client.connector
+    # Connections of every websockets version have a state; not all have closed.
+    if (
+        client.name != name
+        or not connector.connected
+        or connector.ws.state is not State.OPEN
+    ):
+        hass.async_create_task(client.disconnect())
+        return None
+    return client, info
@@ -6,10 +6,86 @@ DOMAIN = "buttplug"
 DEFAULT_NAME = "Home Assistant"
 DEFAULT_SERVER = "ws://localhost:12345"
 
+CONF_KEEPALIVE_INTERVAL = "keepalive_interval"
+CONF_MIN_SEND_INTERVAL = "min_send_interval"
+CONF_PING_CONCURRENCY = "ping_concurrency"
+CONF_PING_EXCLUDE = "ping_exclude"
+CONF_PING_INCLUDE = "ping_include"
+CONF_PING_PATTERN = "ping_pattern"
+CONF_STATE_WRITE_INTERVAL = "state_write_interval"
+CONF_STREAM_HOST = "stream_host"
+CONF_STREAM_PORT = "stream_port"
+CONF_WATCHDOG_TIMEOUT = "watchdog_timeout"
 
+DEFAULT_KEEPALIVE_INTERVAL = 0  # seconds; only as often as the server requires
+DEFAULT_MIN_SEND_INTERVAL = 0.05  # seconds
+DEFAULT_WATCHDOG_TIMEOUT = 0  # seconds; disabled
+DEFAULT_PING_CONCURRENCY = 2
+DEFAULT_STATE_WRITE_INTERVAL = 0.2  # seconds
+DEFAULT_STREAM_HOST = "127.0.0.1"
+DEFAULT_STREAM_PORT = 0  # disabled
+# Devices that have no real off button; they might vibrate while in storage.
+DEFAULT_PING_EXCLUDE = ["WeVibe Moxie", "WeVibe Chorus"]
+
+PING_PATTERN_PULSE = "pulse"
+PING_PATTERN_SHORT = "short"
+PING_PATTERN_OFF = "off"
+PING_PATTERNS = [PING_PATTERN_PULSE, PING_PATTERN_SHORT, PING_PATTERN_OFF]
+DEFAULT_PING_PATTERN = PING_PATTERN_PULSE
+
+DATA_CAPABILITY_CACHE = "capability_cache"
 DATA_CLIENT = "client"
+DATA_COMMAND_QUEUES = "command_queues"
+DATA_CONNECTION = "connection"
+DATA_DEVICE_INDEX = "device_index"
+DATA_PING_SCHEDULER = "ping_scheduler"
 DATA_PLATFORM_SETUP = "platform_setup"
+DATA_STARTUP_TIMINGS = "startup_timings"
+DATA_STREAM = "stream"
+DATA_WATCHDOG = "watchdog"
+# Not per config entry: hass.data key of the session recording in progress.
+DATA_SESSION_RECORDING = f"{DOMAIN}_session_recording"
 
 EVENT_DEVICE_ADDED_TO_REGISTRY = f"{DOMAIN}_device_added_to_registry"
+EVENT_SET_MANY_DISPATCHED = f"{DOMAIN}_set_many_dispatched"
+
+SERVICE_PLAY_PATTERN = "play_pattern"
+SERVICE_PLAY_TRAJECTORY = "play_trajectory"
+SERVICE_REPLAY = "replay"
+SERVICE_SET_DEVICE_STATE = "set_device_state"
+SERVICE_SET_MANY = "set_many"
+SERVICE_SET_VALUE = "set_value"
+SERVICE_START_RECORDING = "start_recording"
+SERVICE_STOP_ALL = "stop_all"
+SERVICE_STOP_DEVICE = "stop_device"
+SERVICE_STOP_PATTERN = "stop_pattern"
+SERVICE_STOP_RECORDING = "stop_recording"
+
+ATTR_DEVICE_FEATURES = "device_features"
+ATTR_DEVICE_MAP = "device_map"
+ATTR_DURATION = "duration"
+ATTR_EASING = "easing"
+ATTR_FILENAME = "filename"
+ATTR_FREQUENCY = "frequency"
+ATTR_KEYFRAMES = "keyframes"
+ATTR_REPEAT = "repeat"
+ATTR_SAMPLE_RATE = "sample_rate"
+ATTR_SAMPLES = "samples"
+ATTR_SKEW = "skew"
+ATTR_SPEED = "speed"
+ATTR_STROKE_MAX = "stroke_max"
+ATTR_STROKE_MIN = "stroke_min"
+ATTR_TARGETS = "targets"
+ATTR_TRANSITION = "transition"
+ATTR_VALUE = "value"
+ATTR_WAVEFORM = "waveform"
+
+CMD_TYPE_VIBRATE = "vibrate"
+CMD_TYPE_ROTATE = "rotate"
+CMD_TYPE_LINEAR = "linear"
+
+BUTTPLUG_CMD_VIBRATE = "VibrateCmd"
+BUTTPLUG_CMD_ROTATE = "RotateCmd"
+BUTTPLUG_CMD_LINEAR = "LinearCmd"
 
 LOGGER = logging.getLogger(__package__)
@@ -0,0 +1,58 @@
+"""Batching of Buttplug devices that arrive close together."""
+from __future__ import annotations
+
+import asyncio
+from collections.abc import Callable
+
+from buttplug.client import ButtplugClientDevice
+from homeassistant.core import HomeAssistant, callback
+
+ARRIVAL_WINDOW = 0.05  # seconds
+
+
+class DeviceBatcher:
+    """Gather devices arriving within a short window and hand them on together.
+
+    The server reports every device on its own, e.g. the whole device list when
+    (re)connecting; batching them turns that into a single registry pass and
+    one entity batch per platform.
+    """
+
+    def __init__(
+        self,
+        hass: HomeAssistant,
+        handler: Callable[[list[ButtplugClientDevice]], None],
+        window: float = ARRIVAL_WINDOW,
+    ) -> None:
+        """Initialize the batcher."""
+        self.hass = hass
+        self._handler = handler
+        self._window = window
+        self._pending: list[ButtplugClientDevice] = []
+        self._timer: asyncio.TimerHandle | None = None
+
+    @callback
+    def async_add(self, dev: ButtplugClientDevice) -> None:
+        """Add a device to the current batch, starting one if needed."""
+        self._pending.append(dev)
+        if self._timer is None:
+            self._timer = self.hass.loop.call_later(self._window, self.async_flush)
+
+    @callback
+    def async_flush(self) -> None:
+        """Hand on the current batch right away."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        devs, self._pending = self._pending, []
+        self._handler(devs)
+
+    @callback
+    def async_shutdown(self) -> None:
+        """Drop the current batch."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._pending.clear()
@@ -0,0 +1,42 @@
+"""Index of connected Buttplug devices by their server-provisioned index."""
+from __future__ import annotations
+
+from collections import Counter
+
+
+class DeviceIndex:
+    """Map Buttplug device indexes to device registry entry ids.
+
+    Several connected devices can share a registry entry when they have the same
+    name, so entries are reference counted.
+    """
+
+    def __init__(self) -> None:
+        """Initialize an empty index."""
+        self._entries: dict[int, str] = {}
+        self._refs: Counter[str] = Counter()
+
+    def __contains__(self, device_id: str) -> bool:
+        """Return whether any connected device uses the registry entry."""
+        return self._refs[device_id] > 0
+
+    def add(self, dev_index: int, device_id: str) -> None:
+        """Record that the device with this index uses the registry entry."""
+        self.remove(dev_index)
+        self._entries[dev_index] = device_id
+        self._refs[device_id] += 1
+
+    def remove(self, dev_index: int) -> str | None:
+        """Forget a device, returning its registry entry if no longer in use."""
+        if (device_id := self._entries.pop(dev_index, None)) is None:
+            return None
+        self._refs[device_id] -= 1
+        if self._refs[device_id] > 0:
+            return None
+        del self._refs[device_id]
+        return device_id
+
+    def clear(self) -> None:
+        """Forget all devices."""
+        self._entries.clear()
+        self._refs.clear()
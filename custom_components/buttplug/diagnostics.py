@@ -0,0 +1,108 @@
+"""Diagnostics support for Buttplug."""
+from __future__ import annotations
+
+from typing import Any
+
+from buttplug.client import ButtplugClient
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant
+
+from .command_queue import DeviceCommandQueue
+from .connection import ServerConnection
+from .const import (
+    DATA_CLIENT,
+    DATA_COMMAND_QUEUES,
+    DATA_CONNECTION,
+    DATA_STARTUP_TIMINGS,
+    DATA_STREAM,
+    DATA_WATCHDOG,
+    DOMAIN,
+)
+from .stream import StreamInput
+from .watchdog import InactivityWatchdog
+
+
+async def async_get_config_entry_diagnostics(
+    hass: HomeAssistant, entry: ConfigEntry
+) -> dict[str, Any]:
+    """Return diagnostics for a config entry."""
+    data = hass.data[DOMAIN][entry.entry_id]
+    client: ButtplugClient | None = data.get(DATA_CLIENT)
+    queues: dict[str, DeviceCommandQueue] = data.get(DATA_COMMAND_QUEUES, {})
+    watchdog: InactivityWatchdog | None = data.get(DATA_WATCHDOG)
+    stream: StreamInput | None = data.get(DATA_STREAM)
+    connection: ServerConnection | None = data.get(DATA_CONNECTION)
+    info = connection.info if connection else None
+    scanner = connection.scanner if connection else None
+    return {
+        "entry": {"data": dict(entry.data), "options": dict(entry.options)},
+        "startup_timings": data.get(DATA_STARTUP_TIMINGS, {}),
+        "connection": (
+            {
+                "connected": connection.connected,
+            }
+            if connection
+            else None
+        ),
+        "scanning": (
+            {
+                "mode": scanner.mode,
+                "scanning": scanner.scanning,
+                "command_rate": scanner.command_rate,
+                "scans": scanner.scans,
+                "active_time": scanner.active_time,
+                "found_per_scan": list(scanner.found),
+            }
+            if scanner
+            else None
+        ),
+        "server": (
+            {
+                "name": info.server_name,
+                "message_version": info.message_version,
+                "max_ping_time": info.max_ping_time,
+            }
+            if info
+            else None
+        ),
+        "watchdog": (
+            {
+                "timeout": watchdog.timeout,
+                "watched": watchdog.watched,
+            }
+            if watchdog
+            else None
+        ),
+        "stream": (
+            {
+                "frames": stream.frames,
+                "frame_rate": stream.frame_rate,
+                "invalid": stream.invalid,
+                "superseded": stream.superseded,
+            }
+            if stream
+            else None
+        ),
+        "devices": {
+            index: {
+                "name": dev.name,
+                "messages": {
+                    message: vars(attributes)
+                    for message, attributes in dev.allowed_messages.items()
+                },
+            }
+            for index, dev in (client.devices.items() if client else ())
+        },
+        "command_queues": {
+            name: {
+                "available": queue.available,
+                "depth": queue.depth,
+                "min_interval": queue.min_interval,
+                "command_rate": queue.limiter.rate,
+                "max_command_rate": queue.limiter.max_rate,
+                "ack_latency": queue.limiter.srtt,
+                "stop_latency": queue.stop_latency,
+            }
+            for name, queue in queues.items()
+        },
+    }
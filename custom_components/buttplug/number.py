@@ -1,8 +1,11 @@
 """Support for Buttplug controls using the number platform."""
 from __future__ import annotations
 
-from websockets.exceptions import ConnectionClosedError
+import asyncio
+import time
+from typing import Any
 
+import voluptuous as vol
 from buttplug.client import (
     ButtplugClient,
     ButtplugClientConnectorError,
@@ -17,19 +20,100 @@ from homeassistant.components.number import (
 )
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.core import HomeAssistant, callback
+from homeassistant.exceptions import HomeAssistantError
+from homeassistant.helpers import config_validation as cv, entity_platform
 from homeassistant.helpers.dispatcher import async_dispatcher_connect
 from homeassistant.helpers.entity import DeviceInfo
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 
-from .const import DATA_CLIENT, DOMAIN, LOGGER
+from .capability_cache import CachedDevice
+from .command_queue import DeviceCommandQueue, async_get_command_queue, make_payload
+from .const import (
+    ATTR_DEVICE_FEATURES,
+    ATTR_EASING,
+    ATTR_FREQUENCY,
+    ATTR_KEYFRAMES,
+    ATTR_REPEAT,
+    ATTR_SAMPLE_RATE,
+    ATTR_SAMPLES,
+    ATTR_STROKE_MAX,
+    ATTR_STROKE_MIN,
+    ATTR_TRANSITION,
+    ATTR_VALUE,
+    ATTR_WAVEFORM,
+    BUTTPLUG_CMD_LINEAR,
+    BUTTPLUG_CMD_ROTATE,
+    BUTTPLUG_CMD_VIBRATE,
+    CMD_TYPE_LINEAR,
+    CMD_TYPE_ROTATE,
+    CMD_TYPE_VIBRATE,
+    CONF_STATE_WRITE_INTERVAL,
+    DATA_CLIENT,
+    DATA_SESSION_RECORDING,
+    DEFAULT_STATE_WRITE_INTERVAL,
+    DOMAIN,
+    SERVICE_PLAY_PATTERN,
+    SERVICE_PLAY_TRAJECTORY,
+    SERVICE_SET_VALUE,
+    SERVICE_STOP_DEVICE,
+    SERVICE_STOP_PATTERN,
+)
+from .pattern import DEFAULT_SAMPLE_RATE, MAX_SAMPLES, Pattern, async_play_pattern
+from .ramp import EASING_LINEAR, EASINGS, async_run_ramp
+from .recording import CMD_TYPE_MESSAGES, CMD_TYPES
+from .trajectory import WAVEFORM_SINE, WAVEFORMS, Trajectory, async_run_trajectory
 
 PARALLEL_UPDATES = 0
-BUTTPLUG_CMD_VIBRATE = "VibrateCmd"
-BUTTPLUG_CMD_ROTATE = "RotateCmd"
-BUTTPLUG_CMD_LINEAR = "LinearCmd"
-CMD_TYPE_VIBRATE = "vibrate"
-CMD_TYPE_ROTATE = "rotate"
-CMD_TYPE_LINEAR = "linear"
+
+PLAY_PATTERN_SCHEMA = vol.All(
+    cv.make_entity_service_schema(
+        {
+            vol.Exclusive(ATTR_KEYFRAMES, "pattern"): vol.All(
+                cv.ensure_list,
+                [vol.ExactSequence([vol.Coerce(float), vol.Coerce(float)])],
+                vol.Length(min=1),
+            ),
+            vol.Exclusive(ATTR_SAMPLES, "pattern"): vol.All(
+                cv.ensure_list, [vol.Coerce(float)], vol.Length(min=1, max=MAX_SAMPLES)
+            ),
+            vol.Optional(ATTR_SAMPLE_RATE, default=DEFAULT_SAMPLE_RATE): vol.All(
+                vol.Coerce(float), vol.Range(min=0.1, max=100)
+            ),
+            vol.Optional(ATTR_REPEAT, default=1): vol.All(
+                vol.Coerce(int), vol.Range(min=0)
+            ),
+        }
+    ),
+    cv.has_at_least_one_key(ATTR_KEYFRAMES, ATTR_SAMPLES),
+)
+
+PLAY_TRAJECTORY_SCHEMA = cv.make_entity_service_schema(
+    {
+        vol.Optional(ATTR_STROKE_MIN, default=0): vol.All(
+            vol.Coerce(float), vol.Range(min=0, max=100)
+        ),
+        vol.Optional(ATTR_STROKE_MAX, default=100): vol.All(
+            vol.Coerce(float), vol.Range(min=0, max=100)
+        ),
+        vol.Required(ATTR_FREQUENCY): vol.All(
+            vol.Coerce(float), vol.Range(min=0.05, max=5)
+        ),
+        vol.Optional(ATTR_WAVEFORM, default=WAVEFORM_SINE): vol.In(WAVEFORMS),
+        vol.Optional(ATTR_REPEAT, default=0): vol.All(
+            vol.Coerce(int), vol.Range(min=0)
+        ),
+    }
+)
+
+TRANSITION = vol.All(vol.Coerce(float), vol.Range(min=0, max=3600))
+
+SET_VALUE_SCHEMA = cv.make_entity_service_schema(
+    {
+        vol.Required(ATTR_VALUE): vol.Coerce(float),
+        vol.Optional(ATTR_TRANSITION, default=0): TRANSITION,
+        vol.Optional(ATTR_EASING, default=EASING_LINEAR): vol.In(list(EASINGS)),
+    }
+)
 
 
 async def async_setup_entry(
@@ -40,10 +124,39 @@ async def async_setup_entry(
     """Set up Buttplug Number entity from Config Entry."""
     client: ButtplugClient = hass.data[DOMAIN][config_entry.entry_id][DATA_CLIENT]
 
+    platform = entity_platform.async_get_current_platform()
+    added: set[str] = set()
+    write_interval = config_entry.options.get(
+        CONF_STATE_WRITE_INTERVAL, DEFAULT_STATE_WRITE_INTERVAL
+    )
+
+    async def async_add_numbers(
+        devs: list[ButtplugClientDevice | CachedDevice], ready: asyncio.Future[None]
+    ) -> None:
+        """Add the Buttplug number entities of several devices in one batch."""
+        try:
+            await platform.async_add_entities(
+                [entity for dev in devs for entity in async_build_entities(dev)]
+            )
+        finally:
+            if not ready.done():
+                ready.set_result(None)
+
     @callback
-    def async_add_number(dev: ButtplugClientDevice) -> None:
-        """Add Buttplug number entity."""
+    def async_build_entities(
+        dev: ButtplugClientDevice | CachedDevice,
+    ) -> list[ButtplugNumberEntity]:
+        """Build the number entities of a device that don't exist yet."""
         entities: list[ButtplugNumberEntity] = []
+        # Binding the queue to the new device object also brings back the
+        # entities created when the device was seen before (e.g. on reconnect,
+        # or from the capability cache at startup).
+        queue = async_get_command_queue(
+            hass,
+            config_entry,
+            dev.name,
+            dev if isinstance(dev, ButtplugClientDevice) else None,
+        )
         for message, attributes in dev.allowed_messages.items():
             handle = True  # TODO golf the section?
             if message == BUTTPLUG_CMD_VIBRATE:
@@ -58,25 +171,48 @@ async def async_setup_entry(
                 sole_index = attributes.feature_count == 1
                 for index in range(0, attributes.feature_count):
                     # LOGGER.info()
-                    entities.append(
-                        ButtplugNumberEntity(dev, cmd_type, index, sole_index)
+                    entity = ButtplugNumberEntity(
+                        dev, queue, cmd_type, index, sole_index, write_interval
                     )
-        async_add_entities(entities)
+                    if entity.unique_id not in added:
+                        added.add(entity.unique_id)
+                        entities.append(entity)
+        return entities
+
+    platform.async_register_entity_service(
+        SERVICE_SET_VALUE, SET_VALUE_SCHEMA, "async_ramp_to"
+    )
+    platform.async_register_entity_service(
+        SERVICE_PLAY_PATTERN, PLAY_PATTERN_SCHEMA, "async_play_pattern"
+    )
+    platform.async_register_entity_service(
+        SERVICE_PLAY_TRAJECTORY, PLAY_TRAJECTORY_SCHEMA, "async_play_trajectory"
+    )
+    platform.async_register_entity_service(
+        SERVICE_STOP_PATTERN, {}, "async_stop_pattern"
+    )
+    platform.async_register_entity_service(SERVICE_STOP_DEVICE, {}, "async_stop_device")
 
     config_entry.async_on_unload(
         async_dispatcher_connect(
             hass,
             f"{DOMAIN}_{config_entry.entry_id}_add_{NUMBER_DOMAIN}",
-            async_add_number,
+            async_add_numbers,
         )
     )
 
 
 # TODO use inputnumber? https://github.com/home-assistant/core/blob/2022.6.7/homeassistant/components/input_number/__init__.py
 class ButtplugNumberEntity(NumberEntity):
-    """Representation of a Buttplug number entity."""
+    """Representation of a Buttplug number entity.
 
-    # TODO allow user to batch commands instead of doing individually for diff motors.
+    Values go to the device as fast as they come, but value changes are written
+    to the state machine at most once per write interval, with the newest value
+    always written in the end. A slider drag or an automation setting values
+    quickly thus doesn't flood the event bus and the recorder.
+    """
+
+    _attr_should_poll = False
 
     icon_mapping = {
         CMD_TYPE_VIBRATE: "mdi:vibrate",
@@ -86,15 +222,27 @@ class ButtplugNumberEntity(NumberEntity):
 
     def __init__(
         self,
-        dev: ButtplugClientDevice,
+        dev: ButtplugClientDevice | CachedDevice,
+        queue: DeviceCommandQueue,
         cmd_type: str,
         index: int,
         sole_index: bool = False,
+        write_interval: float = DEFAULT_STATE_WRITE_INTERVAL,
     ) -> None:
         """Initialize a ButtplugNumberEntity entity."""
         self._dev = dev
+        self._queue = queue
         self._cmd_type = cmd_type
         self._index = index
+        self._write_interval = write_interval
+        self._last_write = 0.0
+        self._write_timer: asyncio.TimerHandle | None = None
+        # What buttplug.set_device_state takes for the device, e.g. {"vibrate": 2}.
+        self._device_features = {
+            feature_type: attributes.feature_count
+            for feature_type, message in zip(CMD_TYPES, CMD_TYPE_MESSAGES)
+            if (attributes := dev.allowed_messages.get(message)) is not None
+        }
         self._attr_native_value = 0
         self._attr_native_max_value = 100
         self._attr_native_min_value = -100 if cmd_type == CMD_TYPE_ROTATE else 0
@@ -116,39 +264,208 @@ class ButtplugNumberEntity(NumberEntity):
             base_attr_name if sole_index else f"{base_attr_name} ({index})"
         )  # TODO client name too?
 
+    @property
+    def available(self) -> bool:
+        """Return whether the device is connected."""
+        return self._queue.available
+
+    @property
+    def command_queue(self) -> DeviceCommandQueue:
+        """Return the command queue of the device."""
+        return self._queue
+
+    @property
+    def feature(self) -> tuple[str, int]:
+        """Return the command type and feature index the entity controls."""
+        return self._cmd_type, self._index
+
+    @property
+    def extra_state_attributes(self) -> dict[str, Any]:
+        """Return the features of the device.
+
+        The command rate and queue depth change with every command, so they are
+        in the diagnostics rather than here, where each change would be recorded.
+        """
+        return {ATTR_DEVICE_FEATURES: self._device_features}
+
+    async def async_added_to_hass(self) -> None:
+        """Call when entity is added."""
+        self.async_on_remove(
+            self._queue.async_add_listener(self._async_handle_queue_update)
+        )
+        self.async_on_remove(self._async_cancel_write)
+
+    @callback
+    def async_write_ha_state(self) -> None:
+        """Write the state right away, superseding a throttled write."""
+        self._async_cancel_write()
+        self._last_write = time.monotonic()
+        super().async_write_ha_state()
+
+    @callback
+    def async_write_ha_state_throttled(self) -> None:
+        """Write the state now or, if written lately, once the interval is over."""
+        if self._write_timer is not None:
+            return  # the pending write picks up the newest value
+        delay = self._last_write + self._write_interval - time.monotonic()
+        if delay <= 0:
+            self.async_write_ha_state()
+        else:
+            self._write_timer = self.hass.loop.call_later(
+                delay, self.async_write_ha_state
+            )
+
+    @callback
+    def _async_cancel_write(self) -> None:
+        if self._write_timer is not None:
+            self._write_timer.cancel()
+            self._write_timer = None
+
+    @callback
+    def _async_handle_queue_update(self) -> None:
+        """Update the state when the device comes or goes or gets stopped."""
+        # Whichever it is, the motor isn't running: a (re)added device starts
+        # out stopped, and the server stops devices that disconnect.
+        if self._cmd_type != CMD_TYPE_LINEAR:
+            self._attr_native_value = 0
+        self.async_write_ha_state()
+
     async def async_set_native_value(self, value: float) -> None:
         """Update the current value."""
-        internal_value = value / 100
-        try:
-            if self._cmd_type == CMD_TYPE_VIBRATE:
-                await self._dev.send_vibrate_cmd({self._index: internal_value})
-            elif self._cmd_type == CMD_TYPE_ROTATE:
-                await self._dev.send_rotate_cmd(
-                    {self._index: (abs(internal_value), internal_value >= 0)}
-                )  # negative means opposite direction
-            elif self._cmd_type == CMD_TYPE_LINEAR:
-                # the device can move back and forth. We can call send_linear_cmd on the device
-                # and it'll tell the server to make the device move to 90% of the
-                # maximum position over 1 second (1000ms).
-                await self._dev.send_linear_cmd(
-                    {self._index: (1000, internal_value)}
-                )  # TODO figure out how to set two numbers at once from the UI for this.
-                # We wait 1 second for the move, then we move it back to the 0% position.
-        except ConnectionClosedError:
-            LOGGER.exception(
-                "Failed to send command to device; connection between Home Assistant and Buttplug server already closed."
+        self._queue.async_cancel_motion(self._cmd_type, self._index)
+        if (recording := self.hass.data.get(DATA_SESSION_RECORDING)) is not None:
+            recording.record(self._dev.name, self._cmd_type, self._index, value / 100)
+        payload = make_payload(self._cmd_type, value / 100)
+        # Values set while an earlier one is still queued replace it, so a slider
+        # drag only sends the newest value instead of every intermediate one.
+        if await self._queue.async_enqueue(self._cmd_type, self._index, payload):
+            self._attr_native_value = value
+            self.async_write_ha_state_throttled()
+
+    async def async_ramp_to(
+        self, value: float, transition: float = 0, easing: str = EASING_LINEAR
+    ) -> None:
+        """Move to a value over a transition, replacing whatever is playing.
+
+        The ramp is interpolated here, so it costs a single call however long it
+        is, and setting another value cancels it. It starts from the value last
+        sent, which may have come from a pattern or trajectory.
+        """
+        if transition <= 0:
+            await self.async_set_native_value(
+                min(max(value, self.native_min_value), self.native_max_value)
             )
-            # TODO send signal to trigger reconnection?
-        except Exception as err:
-            LOGGER.exception(
-                "Exception while sending %s (%s) command to %s: %s",
+            return
+
+        start = self._queue.last_value(self._cmd_type, self._index)
+        if start is None:
+            start = self._to_internal(self.native_value or 0)
+
+        @callback
+        def async_ramp_step(step: float) -> None:
+            self.async_set_sent_value(step * 100)
+
+        self._queue.async_start_motion(
+            self._cmd_type,
+            self._index,
+            async_run_ramp(
+                self._queue,
                 self._cmd_type,
-                internal_value,
+                self._index,
+                start,
+                self._to_internal(value),
+                transition,
+                easing,
+                async_ramp_step,
+            ),
+        )
+
+    def build_command(self, value: float) -> tuple[str, int, Any]:
+        """Return the command type, feature index and payload for setting a value."""
+        return (
+            self._cmd_type,
+            self._index,
+            make_payload(self._cmd_type, self._to_internal(value)),
+        )
+
+    @callback
+    def async_set_sent_value(self, value: float) -> None:
+        """Record a value that was sent to the device outside of the entity."""
+        self._attr_native_value = min(
+            max(value, self.native_min_value), self.native_max_value
+        )
+        if (recording := self.hass.data.get(DATA_SESSION_RECORDING)) is not None:
+            recording.record(
                 self._dev.name,
-                err,
+                self._cmd_type,
+                self._index,
+                self._attr_native_value / 100,
+            )
+        self.async_write_ha_state_throttled()
+
+    def _to_internal(self, value: float) -> float:
+        """Clamp a value to the entity's range and convert it to the internal scale."""
+        return min(max(value, self.native_min_value), self.native_max_value) / 100
+
+    async def async_play_pattern(
+        self,
+        sample_rate: float,
+        repeat: int,
+        keyframes: list[tuple[float, float]] | None = None,
+        samples: list[float] | None = None,
+    ) -> None:
+        """Play a pattern on this feature, replacing any pattern already playing."""
+        if keyframes is not None:
+            pattern = Pattern.from_keyframes(
+                [(at, self._to_internal(value)) for at, value in keyframes],
+                sample_rate,
+                repeat,
             )
         else:
-            self._attr_native_value = value
+            pattern = Pattern(
+                [self._to_internal(value) for value in samples or []],
+                sample_rate,
+                repeat,
+            )
+        self._queue.async_start_motion(
+            self._cmd_type,
+            self._index,
+            async_play_pattern(self._queue, self._cmd_type, self._index, pattern),
+        )
+
+    async def async_play_trajectory(
+        self,
+        stroke_min: float,
+        stroke_max: float,
+        frequency: float,
+        waveform: str,
+        repeat: int,
+    ) -> None:
+        """Stroke continuously, replacing any pattern or trajectory playing."""
+        if self._cmd_type != CMD_TYPE_LINEAR:
+            raise HomeAssistantError(f"{self.entity_id} is not a linear feature")
+        low, high = sorted(
+            (self._to_internal(stroke_min), self._to_internal(stroke_max))
+        )
+        self._queue.async_start_motion(
+            self._cmd_type,
+            self._index,
+            async_run_trajectory(
+                self._queue,
+                self._index,
+                Trajectory(low, high, frequency, waveform, repeat),
+            ),
+        )
+
+    async def async_stop_pattern(self) -> None:
+        """Stop the pattern or trajectory playing on this feature."""
+        self._queue.async_cancel_motion(self._cmd_type, self._index)
+        if self._cmd_type != CMD_TYPE_LINEAR:
+            await self.async_set_native_value(0)
+
+    async def async_stop_device(self) -> None:
+        """Stop the whole device, ahead of anything queued for it."""
+        await self._queue.async_stop()
 
     # async def async_added_to_hass(self) -> None:
     #     """Call when entity is added."""
@@ -0,0 +1,88 @@
+"""Pattern playback for Buttplug devices."""
+from __future__ import annotations
+
+import asyncio
+from bisect import bisect_right
+from collections.abc import Sequence
+from dataclasses import dataclass
+import math
+import time
+
+from .command_queue import DeviceCommandQueue, make_payload
+
+DEFAULT_SAMPLE_RATE = 20.0  # Hz
+MAX_SAMPLES = 36000
+
+
+@dataclass
+class Pattern:
+    """A sequence of intensities sampled at a fixed rate.
+
+    Intensities use the internal scale: 0 to 1, or -1 to 1 for rotation where
+    negative means the opposite direction.
+    """
+
+    samples: Sequence[float]
+    sample_rate: float = DEFAULT_SAMPLE_RATE
+    repeat: int = 1  # 0 repeats forever
+
+    @classmethod
+    def from_keyframes(
+        cls,
+        keyframes: Sequence[tuple[float, float]],
+        sample_rate: float = DEFAULT_SAMPLE_RATE,
+        repeat: int = 1,
+    ) -> Pattern:
+        """Create a pattern by linearly interpolating (seconds, intensity) pairs."""
+        keyframes = sorted(keyframes)
+        times = [at for at, _ in keyframes]
+        count = min(int(times[-1] * sample_rate) + 1, MAX_SAMPLES)
+        samples = []
+        for frame in range(count):
+            at = frame / sample_rate
+            after = bisect_right(times, at)
+            if after == 0:
+                samples.append(keyframes[0][1])
+            elif after == len(keyframes):
+                samples.append(keyframes[-1][1])
+            else:
+                (start, begin), (stop, end) = keyframes[after - 1], keyframes[after]
+                samples.append(begin + (end - begin) * (at - start) / (stop - start))
+        return cls(samples, sample_rate, repeat)
+
+    @property
+    def duration(self) -> float:
+        """Return the duration of one repetition in seconds."""
+        return len(self.samples) / self.sample_rate
+
+
+async def async_play_pattern(
+    queue: DeviceCommandQueue, cmd_type: str, index: int, pattern: Pattern
+) -> None:
+    """Play a pattern on a single feature.
+
+    Frames are scheduled against the monotonic clock from the moment playback
+    started, so sleeps that overshoot don't add up over time. When playback falls
+    behind (e.g. the event loop was busy) stale frames are skipped and the frame
+    that is due now is sent instead.
+    """
+    samples = pattern.samples
+    if not samples:
+        return
+    total = len(samples) * pattern.repeat if pattern.repeat else math.inf
+    period = 1 / pattern.sample_rate
+    start = time.monotonic()
+    frame = 0
+    while frame < total:
+        queue.async_enqueue(
+            cmd_type, index, make_payload(cmd_type, samples[frame % len(samples)])
+        )
+        frame += 1
+        if frame >= total:
+            break
+        delay = start + frame * period - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            due = int((time.monotonic() - start) / period)
+            frame = max(frame, min(due, total - 1))
@@ -0,0 +1,183 @@
+"""Identify pings for newly added Buttplug devices."""
+from __future__ import annotations
+
+import asyncio
+from collections.abc import Mapping
+from typing import Any
+
+from buttplug.client import ButtplugClient, ButtplugClientDevice
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant, callback
+
+from .command_queue import DeviceCommandQueue, async_get_command_queue, make_payload
+from .const import (
+    BUTTPLUG_CMD_LINEAR,
+    BUTTPLUG_CMD_ROTATE,
+    BUTTPLUG_CMD_VIBRATE,
+    CMD_TYPE_LINEAR,
+    CMD_TYPE_ROTATE,
+    CMD_TYPE_VIBRATE,
+    CONF_PING_CONCURRENCY,
+    CONF_PING_EXCLUDE,
+    CONF_PING_INCLUDE,
+    CONF_PING_PATTERN,
+    DEFAULT_PING_CONCURRENCY,
+    DEFAULT_PING_EXCLUDE,
+    DEFAULT_PING_PATTERN,
+    PING_PATTERN_OFF,
+    PING_PATTERN_PULSE,
+    PING_PATTERN_SHORT,
+)
+
+# Messages played by a ping and their command types. Putting rotate first
+# because it takes longer to activate.
+PING_COMMANDS = {
+    BUTTPLUG_CMD_ROTATE: CMD_TYPE_ROTATE,
+    BUTTPLUG_CMD_LINEAR: CMD_TYPE_LINEAR,
+    BUTTPLUG_CMD_VIBRATE: CMD_TYPE_VIBRATE,
+}
+
+# (intensity, seconds, linear position, linear move ms) steps played on every
+# motor of a device. Linear motors make moves of their own rather than follow
+# the intensity: the pulse nudges them out and back.
+PING_PATTERNS: dict[str, list[tuple[float, float, float, int]]] = {
+    PING_PATTERN_PULSE: [
+        (0.1, 0.3, 0.1, 300),
+        (0.5, 0.1, 0, 400),
+        (0.1, 0.3, 0, 200),
+    ],
+    PING_PATTERN_SHORT: [(0.3, 0.3, 0.3, 300)],
+    PING_PATTERN_OFF: [],
+}
+
+SETTLE_DELAY = 1  # seconds without new devices before pinging
+
+
+async def ping_buttplug(
+    dev: ButtplugClientDevice,
+    queue: DeviceCommandQueue,
+    steps: list[tuple[float, float, float, int]],
+    stops: int,
+) -> None:
+    """Ping device through its command queue.
+
+    Gives up as soon as the device is stopped through its command queue (more
+    often than the given number of stops), or something other than the ping is
+    sent to it.
+    """
+    feature_counts = {
+        cmd_type: attributes.feature_count
+        for message, cmd_type in PING_COMMANDS.items()
+        if (attributes := dev.allowed_messages.get(message)) is not None
+    }
+    last_command = queue.last_command
+
+    def interrupted() -> bool:
+        return queue.stops != stops or queue.last_command != last_command
+
+    for intensity, duration, position, move_duration in steps:
+        if interrupted():
+            return
+        await queue.async_send_now(
+            {
+                cmd_type: {
+                    index: (
+                        make_payload(cmd_type, position, move_duration)
+                        if cmd_type == CMD_TYPE_LINEAR
+                        else make_payload(cmd_type, intensity)
+                    )
+                    for index in range(feature_count)
+                }
+                for cmd_type, feature_count in feature_counts.items()
+            }
+        )
+        last_command = queue.last_command
+        await asyncio.sleep(duration)
+    if not interrupted():
+        await queue.async_stop()
+
+
+class PingScheduler:
+    """Ping new devices so they can be identified, a few at a time.
+
+    Pings start once no device has been added for SETTLE_DELAY, so a burst of
+    devices connecting isn't slowed down by pings competing for the adapter.
+    """
+
+    def __init__(
+        self,
+        hass: HomeAssistant,
+        entry: ConfigEntry,
+        client: ButtplugClient,
+        options: Mapping[str, Any],
+    ) -> None:
+        """Initialize the scheduler from the config entry options."""
+        self.hass = hass
+        self.entry = entry
+        self.client = client
+        self.steps = PING_PATTERNS[options.get(CONF_PING_PATTERN, DEFAULT_PING_PATTERN)]
+        self.include = set(options.get(CONF_PING_INCLUDE, []))
+        self.exclude = set(options.get(CONF_PING_EXCLUDE, DEFAULT_PING_EXCLUDE))
+        self._semaphore = asyncio.Semaphore(
+            options.get(CONF_PING_CONCURRENCY, DEFAULT_PING_CONCURRENCY)
+        )
+        self._pending: list[tuple[ButtplugClientDevice, DeviceCommandQueue, int]] = []
+        self._scheduled: set[str] = set()
+        self._timer: asyncio.TimerHandle | None = None
+        self._closed = False
+
+    def should_ping(self, name: str) -> bool:
+        """Return whether a device gets pinged when it's added."""
+        if self.include:
+            return name in self.include
+        return name not in self.exclude
+
+    @callback
+    def async_schedule(
+        self, devs: list[ButtplugClientDevice], only_new: bool = False
+    ) -> None:
+        """Ping devices once adding devices has settled down.
+
+        With only_new, devices that were pinged before are skipped.
+        """
+        if self._closed or not self.steps:
+            return
+        for dev in devs:
+            if only_new and dev.name in self._scheduled:
+                continue
+            self._scheduled.add(dev.name)
+            if self.should_ping(dev.name):
+                queue = async_get_command_queue(self.hass, self.entry, dev.name, dev)
+                # Stopping the device from now on also calls off its ping.
+                self._pending.append((dev, queue, queue.stops))
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending:
+            self._timer = self.hass.loop.call_later(SETTLE_DELAY, self._async_start)
+
+    @callback
+    def _async_start(self) -> None:
+        self._timer = None
+        pending, self._pending = self._pending, []
+        for dev, queue, stops in pending:
+            self.hass.async_create_task(self._async_ping(dev, queue, stops))
+
+    async def _async_ping(
+        self, dev: ButtplugClientDevice, queue: DeviceCommandQueue, stops: int
+    ) -> None:
+        async with self._semaphore:
+            # Skip devices that left (or were replaced) while waiting.
+            index = dev._index  # pylint: disable=protected-access
+            if self._closed or self.client.devices.get(index) is not dev:
+                return
+            await ping_buttplug(dev, queue, self.steps, stops)
+
+    @callback
+    def async_shutdown(self) -> None:
+        """Drop pings that haven't started."""
+        self._closed = True
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._pending.clear()
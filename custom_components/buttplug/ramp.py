@@ -0,0 +1,69 @@
+"""Smooth transitions between values of Buttplug device features."""
+from __future__ import annotations
+
+import asyncio
+from collections.abc import Callable
+import math
+import time
+
+from .command_queue import DeviceCommandQueue, make_payload
+from .const import CMD_TYPE_LINEAR
+
+EASING_LINEAR = "linear"
+EASING_IN = "ease_in"
+EASING_OUT = "ease_out"
+EASING_IN_OUT = "ease_in_out"
+EASINGS: dict[str, Callable[[float], float]] = {
+    EASING_LINEAR: lambda progress: progress,
+    EASING_IN: lambda progress: progress * progress,
+    EASING_OUT: lambda progress: 1 - (1 - progress) ** 2,
+    EASING_IN_OUT: lambda progress: (1 - math.cos(math.pi * progress)) / 2,
+}
+
+MIN_TICK = 0.02  # seconds
+
+
+async def async_run_ramp(
+    queue: DeviceCommandQueue,
+    cmd_type: str,
+    index: int,
+    start: float,
+    end: float,
+    duration: float,
+    easing: str = EASING_LINEAR,
+    on_value: Callable[[float], None] | None = None,
+) -> None:
+    """Move a single feature from one value to another over a duration.
+
+    Values are on the internal scale. The ramp ticks at the rate the rate limiter
+    currently allows for the device, so each tick can actually be sent, and is
+    timed against the monotonic clock so a slow tick doesn't stretch it. Linear
+    features are sent each tick's target as a move lasting until the next tick,
+    or the whole ramp as a single move when easing linearly. on_value is called
+    with every value sent.
+    """
+    ease = EASINGS[easing]
+    began = time.monotonic()
+    if cmd_type == CMD_TYPE_LINEAR and easing == EASING_LINEAR:
+        queue.async_enqueue(
+            cmd_type, index, make_payload(cmd_type, end, round(duration * 1000))
+        )
+        await asyncio.sleep(duration)
+        if on_value is not None:
+            on_value(end)
+        return
+    while True:
+        tick = max(1 / queue.limiter.rate, MIN_TICK)
+        now = time.monotonic()
+        # Linear features move towards where the ramp will be at the next tick.
+        at = now + tick if cmd_type == CMD_TYPE_LINEAR else now
+        progress = min((at - began) / duration, 1.0)
+        value = start + (end - start) * ease(progress)
+        queue.async_enqueue(
+            cmd_type, index, make_payload(cmd_type, value, round(tick * 1000))
+        )
+        if on_value is not None:
+            on_value(value)
+        if progress >= 1:
+            return
+        await asyncio.sleep(tick)
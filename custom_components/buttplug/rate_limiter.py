@@ -0,0 +1,90 @@
+"""Adaptive rate limiting of commands sent to Buttplug devices."""
+from __future__ import annotations
+
+import time
+
+DEFAULT_MAX_RATE = 100.0  # commands per second when no minimum interval is set
+MIN_RATE = 2.0  # commands per second
+BURST = 2.0  # commands
+
+RTT_SMOOTHING = 0.2
+BASE_RTT_RELAXATION = 0.01
+# Latency counts as climbing once the smoothed round-trip time is this many times
+# the lowest one seen, plus some slack for jitter on fast links.
+CONGESTION_FACTOR = 2.0
+CONGESTION_SLACK = 0.005  # seconds
+DECREASE_FACTOR = 0.7
+INCREASE_FRACTION = 0.05  # of the maximum rate, per healthy acknowledgement
+
+
+class AdaptiveRateLimiter:
+    """Token bucket whose rate follows the acknowledgement latency of a device.
+
+    The rate is cut multiplicatively when the smoothed round-trip time of commands
+    climbs well above the lowest seen (the link or device is congested) or a send
+    fails, and grows additively back up to the maximum while it stays healthy.
+    """
+
+    def __init__(self, min_interval: float = 0) -> None:
+        """Initialize the limiter at its maximum rate.
+
+        With a minimum interval, commands are never sent closer together than
+        that; without one the rate is capped at DEFAULT_MAX_RATE with some burst.
+        """
+        self.max_rate = 1 / min_interval if min_interval > 0 else DEFAULT_MAX_RATE
+        self.rate = self.max_rate
+        self.srtt: float | None = None
+        self._base_rtt: float | None = None
+        self._capacity = 1.0 if min_interval > 0 else BURST
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._last_decrease = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(
+            self._capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def delay(self, now: float | None = None) -> float:
+        """Return how long to wait before a command may be sent."""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        return max(0.0, (1 - self._tokens) / self.rate)
+
+    def acquire(self, now: float | None = None) -> None:
+        """Take a token for a command being sent."""
+        self._refill(time.monotonic() if now is None else now)
+        self._tokens -= 1
+
+    def record(self, rtt: float | None) -> None:
+        """Adapt the rate to the round-trip time of an acknowledged command.
+
+        None records a failed send.
+        """
+        now = time.monotonic()
+        if rtt is None:
+            self._decrease(now)
+            return
+        self.srtt = (
+            rtt if self.srtt is None else self.srtt + RTT_SMOOTHING * (rtt - self.srtt)
+        )
+        if self._base_rtt is None or rtt < self._base_rtt:
+            self._base_rtt = rtt
+        else:
+            # Let the baseline follow lasting changes, e.g. the device moving.
+            self._base_rtt += BASE_RTT_RELAXATION * (self.srtt - self._base_rtt)
+        if self.srtt > self._base_rtt * CONGESTION_FACTOR + CONGESTION_SLACK:
+            self._decrease(now)
+        else:
+            self.rate = min(
+                self.max_rate, self.rate + self.max_rate * INCREASE_FRACTION
+            )
+
+    def _decrease(self, now: float) -> None:
+        # Only back off once per round trip; the acknowledgements that are already
+        # on their way were sent at the old rate.
+        if now - self._last_decrease < (self.srtt or 0):
+            return
+        self._last_decrease = now
+        self.rate = max(min(MIN_RATE, self.max_rate), self.rate * DECREASE_FACTOR)
@@ -0,0 +1,198 @@
+"""Compact recording and replay of the values set on Buttplug devices."""
+from __future__ import annotations
+
+import asyncio
+from array import array
+from collections.abc import Sequence
+import struct
+import sys
+import time
+
+from .command_queue import DeviceCommandQueue, make_payload
+from .const import (
+    BUTTPLUG_CMD_LINEAR,
+    BUTTPLUG_CMD_ROTATE,
+    BUTTPLUG_CMD_VIBRATE,
+    CMD_TYPE_LINEAR,
+    CMD_TYPE_ROTATE,
+    CMD_TYPE_VIBRATE,
+    LOGGER,
+)
+
+RECORDINGS_DIR = "buttplug_recordings"
+RECORDING_SUFFIX = ".bpr"
+
+INITIAL_CAPACITY = 4096  # events
+MAX_EVENTS = 1 << 22  # about 64 MB of buffers
+
+# Command types by their code in a recording; codes must never change.
+CMD_TYPES = [CMD_TYPE_VIBRATE, CMD_TYPE_ROTATE, CMD_TYPE_LINEAR]
+CMD_TYPE_CODES = {cmd_type: code for code, cmd_type in enumerate(CMD_TYPES)}
+CMD_TYPE_MESSAGES = [BUTTPLUG_CMD_VIBRATE, BUTTPLUG_CMD_ROTATE, BUTTPLUG_CMD_LINEAR]
+
+MAGIC = b"BPRC"
+VERSION = 1
+# magic, version, number of devices, number of events
+HEADER = struct.Struct("<4sHHI")
+NAME_LENGTH = struct.Struct("<H")
+
+
+class RecordingError(Exception):
+    """Error to indicate a recording file is not valid."""
+
+
+class SessionRecording:
+    """Timeline of values set on devices, held in flat typed arrays.
+
+    Each event takes 16 bytes: the seconds since the recording started, the value
+    on the internal scale, the device (an index into the device names), the
+    feature index and the command type code. The arrays are preallocated and
+    grow by doubling, so recording an event only stores five numbers.
+    """
+
+    def __init__(self, capacity: int = INITIAL_CAPACITY) -> None:
+        """Initialize an empty recording."""
+        self.started = time.monotonic()
+        self.device_names: list[str] = []
+        self._device_ids: dict[str, int] = {}
+        self.count = 0
+        self.times = array("d", bytes(8 * capacity))
+        self.values = array("f", bytes(4 * capacity))
+        self.devices = array("H", bytes(2 * capacity))
+        self.indices = array("B", bytes(capacity))
+        self.cmd_types = array("B", bytes(capacity))
+        self._full = False
+
+    def __len__(self) -> int:
+        """Return the number of events."""
+        return self.count
+
+    @property
+    def duration(self) -> float:
+        """Return the time of the last event in seconds."""
+        return self.times[self.count - 1] if self.count else 0.0
+
+    def record(self, device: str, cmd_type: str, index: int, value: float) -> None:
+        """Append a value set now; the value is on the internal scale."""
+        count = self.count
+        if count == len(self.times) and not self._grow():
+            return
+        if (device_id := self._device_ids.get(device)) is None:
+            device_id = self._device_ids[device] = len(self.device_names)
+            self.device_names.append(device)
+        self.times[count] = time.monotonic() - self.started
+        self.values[count] = value
+        self.devices[count] = device_id
+        self.indices[count] = index
+        self.cmd_types[count] = CMD_TYPE_CODES[cmd_type]
+        self.count = count + 1
+
+    def _grow(self) -> bool:
+        """Double the buffers; return whether there is room for another event."""
+        size = len(self.times)
+        if size >= MAX_EVENTS:
+            if not self._full:
+                self._full = True
+                LOGGER.warning(
+                    "Recording is full after %d events; ignoring the rest", size
+                )
+            return False
+        for buffer in self._buffers():
+            buffer.frombytes(bytes(buffer.itemsize * size))
+        return True
+
+    def _buffers(self) -> tuple[array, ...]:
+        return (self.times, self.values, self.devices, self.indices, self.cmd_types)
+
+    def to_bytes(self) -> bytes:
+        """Serialize the recorded events, little-endian."""
+        parts = [HEADER.pack(MAGIC, VERSION, len(self.device_names), self.count)]
+        for name in self.device_names:
+            encoded = name.encode()
+            parts.append(NAME_LENGTH.pack(len(encoded)))
+            parts.append(encoded)
+        for buffer in self._buffers():
+            used = buffer[: self.count]
+            if sys.byteorder == "big":
+                used.byteswap()
+            parts.append(used.tobytes())
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> SessionRecording:
+        """Deserialize a recording written by to_bytes."""
+        try:
+            magic, version, device_count, count = HEADER.unpack_from(data)
+        except struct.error as err:
+            raise RecordingError("File too short") from err
+        if magic != MAGIC:
+            raise RecordingError("Not a Buttplug recording")
+        if version != VERSION:
+            raise RecordingError(f"Unsupported recording version {version}")
+        recording = cls(0)
+        offset = HEADER.size
+        try:
+            for _ in range(device_count):
+                (length,) = NAME_LENGTH.unpack_from(data, offset)
+                offset += NAME_LENGTH.size
+                name = data[offset : offset + length].decode()
+                offset += length
+                recording._device_ids[name] = len(recording.device_names)
+                recording.device_names.append(name)
+        except (struct.error, UnicodeDecodeError) as err:
+            raise RecordingError("Invalid device names") from err
+        for buffer in recording._buffers():
+            size = buffer.itemsize * count
+            if offset + size > len(data):
+                raise RecordingError("Recording is truncated")
+            buffer.frombytes(data[offset : offset + size])
+            if sys.byteorder == "big":
+                buffer.byteswap()
+            offset += size
+        if any(device >= device_count for device in recording.devices) or any(
+            code >= len(CMD_TYPES) for code in recording.cmd_types
+        ):
+            raise RecordingError("Invalid events")
+        recording.count = count
+        return recording
+
+
+async def async_replay(
+    recording: SessionRecording,
+    queues: Sequence[DeviceCommandQueue | None],
+    speed: float = 1.0,
+) -> None:
+    """Play a recording back through the command queues of live devices.
+
+    queues holds the queue to play each recorded device on, by device index, or
+    None to skip the device. The first event plays right away and the others are
+    scheduled against the monotonic clock from there, with their times divided by
+    speed, so the replay doesn't drift however long it runs. A device that gets
+    stopped during the replay is left alone from then on, and features a device
+    doesn't have (e.g. after remapping) are skipped.
+    """
+    if not recording.count:
+        return
+    stops = [None if queue is None else queue.stops for queue in queues]
+    times, values = recording.times, recording.values
+    devices, indices, cmd_types = (
+        recording.devices,
+        recording.indices,
+        recording.cmd_types,
+    )
+    start = time.monotonic() - times[0] / speed
+    for event in range(recording.count):
+        device = devices[event]
+        if (queue := queues[device]) is None:
+            continue
+        delay = start + times[event] / speed - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if queue.stops != stops[device] or (dev := queue.device) is None:
+            continue
+        code, index = cmd_types[event], indices[event]
+        attributes = dev.allowed_messages.get(CMD_TYPE_MESSAGES[code])
+        if attributes is None or index >= attributes.feature_count:
+            continue
+        cmd_type = CMD_TYPES[code]
+        queue.async_enqueue(cmd_type, index, make_payload(cmd_type, values[event]))
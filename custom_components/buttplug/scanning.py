@@ -0,0 +1,214 @@
+"""Duty-cycled scanning for Buttplug devices."""
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+from collections.abc import Callable
+import logging
+import time
+
+from buttplug.client import ButtplugClient, ButtplugClientDevice
+from homeassistant.core import HomeAssistant, callback
+
+from .const import LOGGER
+
+CHECK_INTERVAL = 1  # seconds
+RESTART_DELAY = 1  # seconds after a scan finished before scanning again
+# Commands per second, over all devices of a server, from which scanning makes
+# way for them: scanning takes radio time from the devices already connected.
+BUSY_RATE = 5.0
+PAUSE_RATE = 10.0
+# Going back to scanning more takes the rate to drop this far below a threshold,
+# so a rate hovering around one doesn't switch scanning on and off.
+CALM_FACTOR = 0.5
+DUTY_SCAN_TIME = 2  # seconds of scanning...
+DUTY_PERIOD = 30  # ...in every this many seconds while busy
+RECENT_SCANS = 10
+# Seconds before retrying a request the server refused, doubling per failure.
+RETRY_DELAY = 2
+MAX_RETRY_DELAY = 300
+
+SCAN_MODE_CONTINUOUS = "continuous"
+SCAN_MODE_DUTY_CYCLE = "duty_cycle"
+SCAN_MODE_PAUSED = "paused"
+
+
+class ScanScheduler:
+    """Keep a server scanning for devices without starving the connected ones.
+
+    While few commands are sent, scanning runs all the time and is restarted
+    shortly after the server finishes a scan. From BUSY_RATE commands per second
+    it only runs for DUTY_SCAN_TIME in every DUTY_PERIOD, and from PAUSE_RATE it
+    pauses until things calm down. The command rate is sampled from a running
+    count of commands sent, once per CHECK_INTERVAL. Start and stop requests are
+    never cancelled once sent (see DeviceCommandQueue); refused ones are retried
+    with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        hass: HomeAssistant,
+        client: ButtplugClient,
+        command_count: Callable[[], int],
+    ) -> None:
+        """Initialize the scheduler; command_count returns the commands sent."""
+        self.hass = hass
+        self.client = client
+        self._command_count = command_count
+        self.mode = SCAN_MODE_CONTINUOUS
+        self.command_rate = 0.0
+        self.scans = 0
+        self.found: deque[int] = deque(maxlen=RECENT_SCANS)
+        self._active_time = 0.0
+        self._scan_started: float | None = None
+        self._scan_ended = 0.0
+        self._scan_found = 0
+        self._sample = (time.monotonic(), 0)
+        self._running = False
+        self._closed = False
+        self._requesting = False
+        self._failures = 0
+        self._retry_at = 0.0
+        self._timer: asyncio.TimerHandle | None = None
+        client.scanning_finished_handler += self._scanning_finished
+        client.device_added_handler += self._device_added
+
+    @property
+    def scanning(self) -> bool:
+        """Return whether the server is scanning."""
+        return self._scan_started is not None
+
+    @property
+    def active_time(self) -> float:
+        """Return the seconds spent scanning in total."""
+        if self._scan_started is None:
+            return self._active_time
+        return self._active_time + time.monotonic() - self._scan_started
+
+    @callback
+    def async_start(self) -> None:
+        """Start scanning on a new connection."""
+        self._running = True
+        self._scan_ended = 0.0
+        self._retry_at = 0.0
+        self._sample = (time.monotonic(), self._command_count())
+        self._async_check()
+
+    @callback
+    def async_suspend(self) -> None:
+        """Stop scheduling scans while the connection is gone."""
+        self._running = False
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._end_scan()
+
+    @callback
+    def async_shutdown(self) -> None:
+        """Stop scheduling scans for good."""
+        self.async_suspend()
+        if self._closed:
+            return
+        self._closed = True
+        self.client.scanning_finished_handler -= self._scanning_finished
+        self.client.device_added_handler -= self._device_added
+
+    def _scanning_finished(self, emitter: ButtplugClient) -> None:
+        # The next check restarts it, if the mode allows.
+        self._end_scan()
+
+    def _device_added(self, emitter: ButtplugClient, dev: ButtplugClientDevice) -> None:
+        if self._scan_started is not None:
+            self._scan_found += 1
+
+    def _begin_scan(self) -> None:
+        self.scans += 1
+        self._scan_started = time.monotonic()
+        self._scan_found = 0
+
+    def _end_scan(self) -> None:
+        if self._scan_started is None:
+            return
+        self._scan_ended = time.monotonic()
+        self._active_time += self._scan_ended - self._scan_started
+        self._scan_started = None
+        self.found.append(self._scan_found)
+
+    def _next_mode(self, rate: float) -> str:
+        if rate >= PAUSE_RATE or (
+            self.mode == SCAN_MODE_PAUSED and rate >= PAUSE_RATE * CALM_FACTOR
+        ):
+            return SCAN_MODE_PAUSED
+        if rate >= BUSY_RATE or (
+            self.mode != SCAN_MODE_CONTINUOUS and rate >= BUSY_RATE * CALM_FACTOR
+        ):
+            return SCAN_MODE_DUTY_CYCLE
+        return SCAN_MODE_CONTINUOUS
+
+    @callback
+    def _async_check(self) -> None:
+        """Follow the command rate, starting or stopping scanning to match."""
+        self._timer = self.hass.loop.call_later(CHECK_INTERVAL, self._async_check)
+        now = time.monotonic()
+        count = self._command_count()
+        sampled, last_count = self._sample
+        self._sample = (now, count)
+        if now > sampled:
+            # Counts start over when config entries reload.
+            self.command_rate = max(0, count - last_count) / (now - sampled)
+        if (mode := self._next_mode(self.command_rate)) != self.mode:
+            LOGGER.debug(
+                "Scanning switched to %s at %.1f commands/s", mode, self.command_rate
+            )
+            self.mode = mode
+
+        if self._scan_started is not None:
+            scan_wanted = self.mode == SCAN_MODE_CONTINUOUS or (
+                self.mode == SCAN_MODE_DUTY_CYCLE
+                and now - self._scan_started < DUTY_SCAN_TIME
+            )
+        elif self.mode == SCAN_MODE_CONTINUOUS:
+            scan_wanted = now - self._scan_ended >= RESTART_DELAY
+        else:
+            scan_wanted = (
+                self.mode == SCAN_MODE_DUTY_CYCLE
+                and now - self._scan_ended >= DUTY_PERIOD - DUTY_SCAN_TIME
+            )
+        if (
+            scan_wanted != self.scanning
+            and not self._requesting
+            and now >= self._retry_at
+        ):
+            self._requesting = True
+            self.hass.async_create_task(self._async_request(scan_wanted))
+
+    async def _async_request(self, start: bool) -> None:
+        """Ask the server to start or stop scanning."""
+        try:
+            if start:
+                await self.client.start_scanning()
+            else:
+                await self.client.stop_scanning()
+        except Exception as err:  # pylint: disable=broad-except
+            if self._running:
+                self._failures += 1
+                delay = min(RETRY_DELAY * 2 ** (self._failures - 1), MAX_RETRY_DELAY)
+                self._retry_at = time.monotonic() + delay
+                # Warn once; a server that keeps refusing shouldn't flood the log.
+                LOGGER.log(
+                    logging.WARNING if self._failures == 1 else logging.DEBUG,
+                    "Failed to %s scanning, retrying in %d s: %s",
+                    "start" if start else "stop",
+                    delay,
+                    err,
+                )
+            return
+        finally:
+            self._requesting = False
+        self._failures = 0
+        if not self._running:
+            return
+        if start:
+            self._begin_scan()
+        else:
+            self._end_scan()
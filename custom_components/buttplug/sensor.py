@@ -0,0 +1,189 @@
+"""Support for Buttplug link diagnostics using the sensor platform."""
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime
+
+from buttplug.client import ButtplugClientDevice
+
+from homeassistant.components.sensor import (
+    DOMAIN as SENSOR_DOMAIN,
+    SensorEntity,
+    SensorStateClass,
+)
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.const import TIME_MILLISECONDS
+from homeassistant.core import CALLBACK_TYPE, HomeAssistant, callback
+from homeassistant.helpers import entity_platform
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
+from homeassistant.helpers.entity import DeviceInfo, EntityCategory
+from homeassistant.helpers.entity_platform import AddEntitiesCallback
+from homeassistant.helpers.event import async_call_later
+
+from .capability_cache import CachedDevice
+from .command_queue import DeviceCommandQueue, async_get_command_queue
+from .const import DOMAIN
+
+PARALLEL_UPDATES = 0
+
+MIN_REFRESH_INTERVAL = 5  # seconds
+MAX_REFRESH_INTERVAL = 60  # seconds
+# Changes smaller than this (relative, or absolute in ms) count as stable.
+RELATIVE_TOLERANCE = 0.1
+ABSOLUTE_TOLERANCE = 1.0
+
+
+async def async_setup_entry(
+    hass: HomeAssistant,
+    config_entry: ConfigEntry,
+    async_add_entities: AddEntitiesCallback,
+) -> None:
+    """Set up Buttplug sensor entities from Config Entry."""
+    refresher = SensorRefresher(hass)
+    config_entry.async_on_unload(refresher.async_shutdown)
+
+    platform = entity_platform.async_get_current_platform()
+    added: set[str] = set()
+
+    async def async_add_sensors(
+        devs: list[ButtplugClientDevice | CachedDevice], ready: asyncio.Future[None]
+    ) -> None:
+        """Add the Buttplug sensor entities of several devices in one batch."""
+        entities: list[ButtplugLatencySensor] = []
+        try:
+            for dev in devs:
+                queue = async_get_command_queue(
+                    hass,
+                    config_entry,
+                    dev.name,
+                    dev if isinstance(dev, ButtplugClientDevice) else None,
+                )
+                entity = ButtplugLatencySensor(dev, queue, refresher)
+                if entity.unique_id not in added:
+                    added.add(entity.unique_id)
+                    entities.append(entity)
+            await platform.async_add_entities(entities)
+        finally:
+            if not ready.done():
+                ready.set_result(None)
+
+    config_entry.async_on_unload(
+        async_dispatcher_connect(
+            hass,
+            f"{DOMAIN}_{config_entry.entry_id}_add_{SENSOR_DOMAIN}",
+            async_add_sensors,
+        )
+    )
+
+
+class SensorRefresher:
+    """Refresh every sensor of a config entry from a single timer.
+
+    The interval starts short and doubles up to MAX_REFRESH_INTERVAL while no
+    sensor changes noticeably, and drops back as soon as one does.
+    """
+
+    def __init__(self, hass: HomeAssistant) -> None:
+        """Initialize the refresher."""
+        self.hass = hass
+        self.interval: float = MIN_REFRESH_INTERVAL
+        self._sensors: set[ButtplugLatencySensor] = set()
+        self._unsub: CALLBACK_TYPE | None = None
+        self._closed = False
+
+    @callback
+    def async_add(self, sensor: ButtplugLatencySensor) -> CALLBACK_TYPE:
+        """Refresh a sensor from now on; returns a callback to stop."""
+        self._sensors.add(sensor)
+        # Sensors still being added while the entry unloads mustn't restart it.
+        if self._unsub is None and not self._closed:
+            self._schedule()
+
+        @callback
+        def remove_sensor() -> None:
+            self._sensors.discard(sensor)
+
+        return remove_sensor
+
+    def _schedule(self) -> None:
+        self._unsub = async_call_later(self.hass, self.interval, self._async_refresh)
+
+    @callback
+    def _async_refresh(self, _: datetime) -> None:
+        """Refresh all sensors and adapt the interval."""
+        changed = False
+        for sensor in self._sensors:
+            changed |= sensor.async_refresh()
+        self.interval = (
+            MIN_REFRESH_INTERVAL
+            if changed
+            else min(self.interval * 2, MAX_REFRESH_INTERVAL)
+        )
+        self._schedule()
+
+    @callback
+    def async_shutdown(self) -> None:
+        """Stop refreshing."""
+        self._closed = True
+        if self._unsub is not None:
+            self._unsub()
+            self._unsub = None
+        self._sensors.clear()
+
+
+class ButtplugLatencySensor(SensorEntity):
+    """Smoothed command acknowledgement latency of a Buttplug device.
+
+    Tracks the quality of the link to the device, as the Buttplug protocol spoken
+    by the client has no battery or signal strength readings.
+    """
+
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+    _attr_icon = "mdi:timer-sand"
+    _attr_native_unit_of_measurement = TIME_MILLISECONDS
+    _attr_should_poll = False
+    _attr_state_class = SensorStateClass.MEASUREMENT
+
+    def __init__(
+        self,
+        dev: ButtplugClientDevice | CachedDevice,
+        queue: DeviceCommandQueue,
+        refresher: SensorRefresher,
+    ) -> None:
+        """Initialize a ButtplugLatencySensor entity."""
+        self._queue = queue
+        self._refresher = refresher
+        self._attr_device_info = DeviceInfo(identifiers={dev.name})
+        self._attr_unique_id = f"{dev.name}_ack_latency"
+        self._attr_name = f"{dev.name}: Ack latency"
+        self._attr_native_value = self._latency()
+
+    @property
+    def available(self) -> bool:
+        """Return whether the device is connected."""
+        return self._queue.available
+
+    def _latency(self) -> float | None:
+        srtt = self._queue.limiter.srtt
+        return None if srtt is None else round(srtt * 1000, 1)
+
+    async def async_added_to_hass(self) -> None:
+        """Call when entity is added."""
+        self.async_on_remove(self._queue.async_add_listener(self.async_write_ha_state))
+        self.async_on_remove(self._refresher.async_add(self))
+
+    @callback
+    def async_refresh(self) -> bool:
+        """Update the state if the latency changed noticeably; return whether so."""
+        latency = self._latency()
+        previous = self._attr_native_value
+        if latency == previous or (
+            latency is not None
+            and previous is not None
+            and abs(latency - previous)
+            <= max(ABSOLUTE_TOLERANCE, previous * RELATIVE_TOLERANCE)
+        ):
+            return False
+        self._attr_native_value = latency
+        self.async_write_ha_state()
+        return True
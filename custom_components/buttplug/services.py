@@ -0,0 +1,385 @@
+"""Services for the Buttplug integration that span several devices."""
+from __future__ import annotations
+
+import asyncio
+from collections import defaultdict
+from datetime import datetime
+import os
+import time
+from typing import Any
+
+import voluptuous as vol
+
+from homeassistant.components.number import DOMAIN as NUMBER_DOMAIN
+from homeassistant.const import ATTR_DEVICE_ID, ATTR_ENTITY_ID
+from homeassistant.core import HomeAssistant, ServiceCall, callback
+from homeassistant.exceptions import HomeAssistantError
+from homeassistant.helpers import (
+    config_validation as cv,
+    device_registry,
+    entity_registry,
+)
+
+from .command_queue import DeviceCommandQueue, async_stop_all_devices, make_payload
+from .const import (
+    ATTR_DEVICE_MAP,
+    ATTR_DURATION,
+    ATTR_EASING,
+    ATTR_FILENAME,
+    ATTR_SKEW,
+    ATTR_SPEED,
+    ATTR_TARGETS,
+    ATTR_TRANSITION,
+    ATTR_VALUE,
+    CMD_TYPE_LINEAR,
+    CMD_TYPE_ROTATE,
+    CMD_TYPE_VIBRATE,
+    DATA_COMMAND_QUEUES,
+    DATA_SESSION_RECORDING,
+    DOMAIN,
+    EVENT_SET_MANY_DISPATCHED,
+    LOGGER,
+    SERVICE_REPLAY,
+    SERVICE_SET_DEVICE_STATE,
+    SERVICE_SET_MANY,
+    SERVICE_START_RECORDING,
+    SERVICE_STOP_ALL,
+    SERVICE_STOP_RECORDING,
+)
+from .number import TRANSITION, ButtplugNumberEntity
+from .ramp import EASING_LINEAR, EASINGS
+from .recording import (
+    CMD_TYPE_CODES,
+    CMD_TYPE_MESSAGES,
+    RECORDING_SUFFIX,
+    RECORDINGS_DIR,
+    RecordingError,
+    SessionRecording,
+    async_replay,
+)
+
+# Plain file names only, so recordings stay in their directory.
+FILENAME = vol.All(cv.string, vol.Match(r"^\w[\w.-]*$"))
+
+SET_MANY_SCHEMA = vol.Schema(
+    {
+        vol.Required(ATTR_TARGETS): vol.All(
+            cv.ensure_list,
+            [
+                vol.Schema(
+                    {
+                        vol.Required(ATTR_ENTITY_ID): cv.entity_id,
+                        vol.Required(ATTR_VALUE): vol.Coerce(float),
+                    }
+                )
+            ],
+            vol.Length(min=1),
+        ),
+        vol.Optional(ATTR_TRANSITION, default=0): TRANSITION,
+        vol.Optional(ATTR_EASING, default=EASING_LINEAR): vol.In(list(EASINGS)),
+    }
+)
+
+
+def _feature_values(minimum: float) -> vol.All:
+    """Validate a list of feature values; None leaves a feature as it is."""
+    return vol.All(
+        cv.ensure_list,
+        [vol.Any(None, vol.All(vol.Coerce(float), vol.Range(min=minimum, max=100)))],
+        vol.Length(min=1),
+    )
+
+
+SET_DEVICE_STATE_SCHEMA = vol.All(
+    vol.Schema(
+        {
+            vol.Required(ATTR_DEVICE_ID): vol.All(cv.ensure_list, [cv.string]),
+            vol.Optional(CMD_TYPE_VIBRATE): _feature_values(0),
+            vol.Optional(CMD_TYPE_ROTATE): _feature_values(-100),
+            vol.Optional(CMD_TYPE_LINEAR): _feature_values(0),
+            vol.Optional(ATTR_TRANSITION, default=0): TRANSITION,
+            vol.Optional(ATTR_EASING, default=EASING_LINEAR): vol.In(list(EASINGS)),
+        }
+    ),
+    cv.has_at_least_one_key(CMD_TYPE_VIBRATE, CMD_TYPE_ROTATE, CMD_TYPE_LINEAR),
+)
+
+START_RECORDING_SCHEMA = vol.Schema({vol.Optional(ATTR_FILENAME): FILENAME})
+
+REPLAY_SCHEMA = vol.Schema(
+    {
+        vol.Required(ATTR_FILENAME): FILENAME,
+        vol.Optional(ATTR_SPEED, default=1.0): vol.All(
+            vol.Coerce(float), vol.Range(min=0.1, max=10)
+        ),
+        vol.Optional(ATTR_DEVICE_MAP, default={}): {cv.string: cv.string},
+    }
+)
+
+
+def _recording_path(hass: HomeAssistant, filename: str) -> str:
+    """Return the path of a recording file, adding the suffix if missing."""
+    if not filename.endswith(RECORDING_SUFFIX):
+        filename += RECORDING_SUFFIX
+    return hass.config.path(RECORDINGS_DIR, filename)
+
+
+def _write_recording(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(data)
+
+
+def _read_recording(path: str) -> SessionRecording:
+    with open(path, "rb") as file:
+        return SessionRecording.from_bytes(file.read())
+
+
+@callback
+def async_setup_services(hass: HomeAssistant) -> None:
+    """Register the Buttplug services."""
+    recording_filename: str | None = None
+    replay_task: asyncio.Task | None = None
+
+    @callback
+    def async_find_queue(name: str) -> DeviceCommandQueue | None:
+        """Return the command queue of a device on any server."""
+        for data in hass.data[DOMAIN].values():
+            if (queue := data.get(DATA_COMMAND_QUEUES, {}).get(name)) is not None:
+                return queue
+        return None
+
+    @callback
+    def async_cancel_replay() -> None:
+        nonlocal replay_task
+        if replay_task is not None:
+            replay_task.cancel()
+            replay_task = None
+
+    async def async_set_many(call: ServiceCall) -> None:
+        """Set several features at once, starting them together."""
+        component = hass.data.get(NUMBER_DOMAIN)
+        entities: list[tuple[ButtplugNumberEntity, float]] = []
+        for target in call.data[ATTR_TARGETS]:
+            entity_id = target[ATTR_ENTITY_ID]
+            entity = component.get_entity(entity_id) if component else None
+            if not isinstance(entity, ButtplugNumberEntity):
+                raise HomeAssistantError(f"{entity_id} is not a Buttplug entity")
+            entities.append((entity, target[ATTR_VALUE]))
+
+        if (transition := call.data[ATTR_TRANSITION]) > 0:
+            # Starting every ramp in the same pass keeps them in step.
+            for entity, value in entities:
+                await entity.async_ramp_to(value, transition, call.data[ATTR_EASING])
+            return
+
+        # Build every message up front so nothing but sending happens between
+        # the first and the last dispatch.
+        batches: dict[DeviceCommandQueue, dict[str, dict[int, Any]]] = defaultdict(
+            lambda: defaultdict(dict)
+        )
+        for entity, value in entities:
+            cmd_type, index, payload = entity.build_command(value)
+            batches[entity.command_queue][cmd_type][index] = payload
+
+        # When each device's messages actually went out, after any flush
+        # already sending to it.
+        dispatched: list[float] = []
+        start = time.monotonic()
+        results = dict(
+            zip(
+                batches,
+                await asyncio.gather(
+                    *(
+                        queue.async_send_now(batch, dispatched)
+                        for queue, batch in batches.items()
+                    )
+                ),
+            )
+        )
+        duration = time.monotonic() - start
+        skew = max(dispatched) - min(dispatched)
+        LOGGER.debug(
+            "Sent %d values to %d devices with %.2f ms dispatch skew in %.2f ms",
+            len(entities),
+            len(batches),
+            skew * 1000,
+            duration * 1000,
+        )
+        hass.bus.async_fire(
+            EVENT_SET_MANY_DISPATCHED,
+            {
+                ATTR_TARGETS: len(entities),
+                ATTR_SKEW: skew,
+                ATTR_DURATION: duration,
+            },
+        )
+
+        for entity, value in entities:
+            if results[entity.command_queue]:
+                entity.async_set_sent_value(value)
+
+    @callback
+    def async_find_device_queue(device_id: str) -> DeviceCommandQueue:
+        """Return the command queue of a device in the device registry."""
+        device = device_registry.async_get(hass).async_get(device_id)
+        if device is None or device.model is None:
+            raise HomeAssistantError(f"Unknown device {device_id}")
+        for entry_id in device.config_entries:
+            data = hass.data[DOMAIN].get(entry_id, {})
+            if (
+                queue := data.get(DATA_COMMAND_QUEUES, {}).get(device.model)
+            ) is not None:
+                return queue
+        raise HomeAssistantError(f"{device.model} is not a Buttplug device")
+
+    async def async_set_device_state(call: ServiceCall) -> None:
+        """Set every given feature of devices at once, one message per command type."""
+        values = {
+            cmd_type: call.data[cmd_type]
+            for cmd_type in (CMD_TYPE_VIBRATE, CMD_TYPE_ROTATE, CMD_TYPE_LINEAR)
+            if cmd_type in call.data
+        }
+        # Validate everything before sending anything.
+        queues: dict[str, DeviceCommandQueue] = {}
+        for device_id in call.data[ATTR_DEVICE_ID]:
+            queue = queues[device_id] = async_find_device_queue(device_id)
+            if (dev := queue.device) is None:
+                raise HomeAssistantError(f"{device_id} is not connected")
+            for cmd_type, features in values.items():
+                message = CMD_TYPE_MESSAGES[CMD_TYPE_CODES[cmd_type]]
+                if (attributes := dev.allowed_messages.get(message)) is None:
+                    raise HomeAssistantError(f"{dev.name} can't {cmd_type}")
+                if len(features) > attributes.feature_count:
+                    raise HomeAssistantError(
+                        f"{dev.name} has {attributes.feature_count} {cmd_type}"
+                        f" feature(s), got {len(features)} values"
+                    )
+
+        # The entities of each device, by the feature they control.
+        ent_reg = entity_registry.async_get(hass)
+        component = hass.data.get(NUMBER_DOMAIN)
+        device_entities: dict[str, dict[tuple[str, int], ButtplugNumberEntity]] = {}
+        for device_id in queues:
+            device_entities[device_id] = {}
+            for registry_entry in entity_registry.async_entries_for_device(
+                ent_reg, device_id
+            ):
+                entity = (
+                    component.get_entity(registry_entry.entity_id)
+                    if component
+                    else None
+                )
+                if isinstance(entity, ButtplugNumberEntity):
+                    device_entities[device_id][entity.feature] = entity
+
+        targets = [
+            ((cmd_type, index), value)
+            for cmd_type, features in values.items()
+            for index, value in enumerate(features)
+            if value is not None
+        ]
+        if (transition := call.data[ATTR_TRANSITION]) > 0:
+            for entities in device_entities.values():
+                for feature, value in targets:
+                    if (entity := entities.get(feature)) is not None:
+                        await entity.async_ramp_to(
+                            value, transition, call.data[ATTR_EASING]
+                        )
+            return
+
+        batch: dict[str, dict[int, Any]] = defaultdict(dict)
+        for (cmd_type, index), value in targets:
+            batch[cmd_type][index] = make_payload(cmd_type, value / 100)
+        results = await asyncio.gather(
+            *(queue.async_send_now(batch) for queue in queues.values())
+        )
+        for entities, result in zip(device_entities.values(), results):
+            if result:
+                for feature, value in targets:
+                    if (entity := entities.get(feature)) is not None:
+                        entity.async_set_sent_value(value)
+
+    async def async_stop_all(call: ServiceCall) -> None:
+        """Stop every device of every server, ahead of anything queued."""
+        async_cancel_replay()
+        await asyncio.gather(
+            *(
+                async_stop_all_devices(hass, entry)
+                for entry in hass.config_entries.async_entries(DOMAIN)
+                if entry.entry_id in hass.data[DOMAIN]
+            )
+        )
+
+    async def async_start_recording(call: ServiceCall) -> None:
+        """Record every value set on the Buttplug entities from now on."""
+        nonlocal recording_filename
+        if DATA_SESSION_RECORDING in hass.data:
+            raise HomeAssistantError("Already recording")
+        recording_filename = call.data.get(
+            ATTR_FILENAME, f"session-{datetime.now():%Y%m%d-%H%M%S}"
+        )
+        hass.data[DATA_SESSION_RECORDING] = SessionRecording()
+
+    async def async_stop_recording(call: ServiceCall) -> None:
+        """Stop recording and write the recording to its file."""
+        recording: SessionRecording | None = hass.data.pop(DATA_SESSION_RECORDING, None)
+        if recording is None or recording_filename is None:
+            raise HomeAssistantError("Not recording")
+        path = _recording_path(hass, recording_filename)
+        await hass.async_add_executor_job(_write_recording, path, recording.to_bytes())
+        LOGGER.info(
+            "Recorded %d values over %.1f s to %s",
+            len(recording),
+            recording.duration,
+            path,
+        )
+
+    async def async_replay_recording(call: ServiceCall) -> None:
+        """Play a recording back on the live devices, replacing any replay."""
+        nonlocal replay_task
+        path = _recording_path(hass, call.data[ATTR_FILENAME])
+        try:
+            recording = await hass.async_add_executor_job(_read_recording, path)
+        except (OSError, RecordingError) as err:
+            raise HomeAssistantError(f"Can't read recording {path}: {err}") from err
+        device_map: dict[str, str] = call.data[ATTR_DEVICE_MAP]
+        queues = [
+            async_find_queue(device_map.get(name, name))
+            for name in recording.device_names
+        ]
+        if not any(queues):
+            raise HomeAssistantError("None of the recorded devices are known")
+        async_cancel_replay()
+        task = replay_task = hass.async_create_task(
+            async_replay(recording, queues, call.data[ATTR_SPEED])
+        )
+
+        @callback
+        def _async_replay_done(_: asyncio.Task) -> None:
+            nonlocal replay_task
+            if replay_task is task:
+                replay_task = None
+
+        task.add_done_callback(_async_replay_done)
+
+    hass.services.async_register(
+        DOMAIN, SERVICE_SET_MANY, async_set_many, schema=SET_MANY_SCHEMA
+    )
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_SET_DEVICE_STATE,
+        async_set_device_state,
+        schema=SET_DEVICE_STATE_SCHEMA,
+    )
+    hass.services.async_register(DOMAIN, SERVICE_STOP_ALL, async_stop_all)
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_START_RECORDING,
+        async_start_recording,
+        schema=START_RECORDING_SCHEMA,
+    )
+    hass.services.async_register(DOMAIN, SERVICE_STOP_RECORDING, async_stop_recording)
+    hass.services.async_register(
+        DOMAIN, SERVICE_REPLAY, async_replay_recording, schema=REPLAY_SCHEMA
+    )
@@ -0,0 +1,152 @@
+"""Low-latency UDP input of intensities streamed by external programs."""
+from __future__ import annotations
+
+import asyncio
+import ipaddress
+import math
+import struct
+import time
+from typing import Any, cast
+
+from buttplug.client import ButtplugClient
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant
+
+from .command_queue import LINEAR_MOVE_DURATION, async_get_command_queue, make_payload
+from .const import CMD_TYPE_ROTATE, LOGGER
+from .recording import CMD_TYPE_MESSAGES, CMD_TYPES
+
+# device index, command type code, feature index, value, linear move duration (ms)
+FRAME = struct.Struct("<HBBfH")
+RATE_WINDOW = 1.0  # seconds
+
+
+def is_loopback(host: str) -> bool:
+    """Return whether only programs on this machine can reach the address."""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class StreamInput(asyncio.DatagramProtocol):
+    """Route streamed frames straight to the command queues of the devices.
+
+    Each datagram holds one or more frames. A frame addresses a feature by the
+    device index the server assigned, the command type code (0 vibrate, 1 rotate,
+    2 linear, as in recordings) and the feature index, and sets it to a value on
+    the internal scale. Linear moves take the given duration, or the default one
+    for 0. Frames skip Home Assistant's state machine and event bus, and the
+    command queues keep only the newest value per feature, so a fast source can't
+    make devices fall behind.
+    """
+
+    def __init__(
+        self, hass: HomeAssistant, entry: ConfigEntry, client: ButtplugClient
+    ) -> None:
+        """Initialize the stream input."""
+        self.hass = hass
+        self.entry = entry
+        self.client = client
+        self.transport: asyncio.DatagramTransport | None = None
+        self.frames = 0
+        self.invalid = 0
+        self.superseded = 0
+        self._window_start = time.monotonic()
+        self._window_frames = 0
+        self._rate = 0.0
+
+    @property
+    def frame_rate(self) -> float:
+        """Return the frames per second received lately."""
+        if time.monotonic() - self._window_start > 2 * RATE_WINDOW:
+            return 0.0
+        return self._rate
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        """Keep the transport to close it later."""
+        self.transport = cast(asyncio.DatagramTransport, transport)
+
+    def datagram_received(self, data: bytes, addr: tuple[str | Any, int]) -> None:
+        """Apply the frames of a datagram."""
+        usable = len(data) - len(data) % FRAME.size
+        if usable != len(data):
+            self.invalid += 1
+        count = usable // FRAME.size
+        self.frames += count
+        for frame in FRAME.iter_unpack(memoryview(data)[:usable]):
+            self._apply(*frame)
+
+        now = time.monotonic()
+        if now - self._window_start > 2 * RATE_WINDOW:
+            # The stream was idle; don't average over the gap.
+            self._window_start = now
+            self._window_frames = 0
+        self._window_frames += count
+        if (elapsed := now - self._window_start) >= RATE_WINDOW:
+            self._rate = self._window_frames / elapsed
+            self._window_start = now
+            self._window_frames = 0
+
+    def _apply(
+        self, dev_index: int, code: int, index: int, value: float, duration: int
+    ) -> None:
+        """Queue the value of a single frame."""
+        dev = self.client.devices.get(dev_index)
+        attributes = (
+            dev.allowed_messages.get(CMD_TYPE_MESSAGES[code])
+            if dev is not None and code < len(CMD_TYPES)
+            else None
+        )
+        if (
+            dev is None
+            or attributes is None
+            or index >= attributes.feature_count
+            or not math.isfinite(value)
+        ):
+            self.invalid += 1
+            return
+        cmd_type = CMD_TYPES[code]
+        value = min(max(value, -1.0 if cmd_type == CMD_TYPE_ROTATE else 0.0), 1.0)
+        payload = make_payload(cmd_type, value, duration or LINEAR_MOVE_DURATION)
+        queue = async_get_command_queue(self.hass, self.entry, dev.name, dev)
+        depth = queue.depth
+        queue.async_enqueue(cmd_type, index, payload, immediate=True)
+        if queue.depth == depth:
+            self.superseded += 1
+
+    def close(self) -> None:
+        """Stop listening."""
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+
+async def async_start_stream(
+    hass: HomeAssistant,
+    entry: ConfigEntry,
+    client: ButtplugClient,
+    host: str,
+    port: int,
+) -> StreamInput | None:
+    """Listen for streamed frames; return None if the port can't be opened."""
+    try:
+        _, stream = await hass.loop.create_datagram_endpoint(
+            lambda: StreamInput(hass, entry, client), local_addr=(host, port)
+        )
+    except OSError as err:
+        LOGGER.error("Can't listen for streamed input on %s:%s: %s", host, port, err)
+        return None
+    LOGGER.info("Listening for streamed input on %s:%s", host, port)
+    if not is_loopback(host):
+        # Frames aren't authenticated: anyone who can reach the port can drive
+        # the devices.
+        LOGGER.warning(
+            "Streamed input on %s:%s accepts frames from other machines without "
+            "any authentication; listen on 127.0.0.1 unless the network is trusted",
+            host,
+            port,
+        )
+    return stream
@@ -0,0 +1,103 @@
+"""Continuous stroking motion for linear Buttplug devices."""
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+import math
+import time
+
+from .command_queue import BATCH_WINDOW, DeviceCommandQueue, make_payload
+from .const import CMD_TYPE_LINEAR
+
+WAVEFORM_SINE = "sine"
+WAVEFORM_TRIANGLE = "triangle"
+WAVEFORM_SAWTOOTH = "sawtooth"
+WAVEFORM_SQUARE = "square"
+WAVEFORMS = [WAVEFORM_SINE, WAVEFORM_TRIANGLE, WAVEFORM_SAWTOOTH, WAVEFORM_SQUARE]
+
+SINE_STEPS = 4  # linear moves approximating each half stroke of a sine
+MIN_SEGMENT_DURATION = 0.1  # seconds
+SAWTOOTH_RISE = 0.8  # fraction of the period spent moving up
+SQUARE_MOVE = 0.2  # fraction of each half period spent moving
+MAX_LEAD = 0.25  # seconds
+
+
+@dataclass
+class Trajectory:
+    """Repeated strokes between two positions.
+
+    Positions use the internal scale of 0 to 1.
+    """
+
+    low: float
+    high: float
+    frequency: float  # strokes per second
+    waveform: str = WAVEFORM_SINE
+    repeat: int = 0  # 0 repeats forever
+
+    def segments(self) -> list[tuple[float, float]]:
+        """Return one stroke as (seconds, position) moves.
+
+        Each move ends at its position after its duration. A move to the position
+        the previous one ended at is a hold.
+        """
+        low, high = self.low, self.high
+        period = 1 / self.frequency
+        half = period / 2
+        if self.waveform == WAVEFORM_TRIANGLE:
+            return [(half, high), (half, low)]
+        if self.waveform == WAVEFORM_SAWTOOTH:
+            return [(period * SAWTOOTH_RISE, high), (period * (1 - SAWTOOTH_RISE), low)]
+        if self.waveform == WAVEFORM_SQUARE:
+            return [
+                (half * SQUARE_MOVE, high),
+                (half * (1 - SQUARE_MOVE), high),
+                (half * SQUARE_MOVE, low),
+                (half * (1 - SQUARE_MOVE), low),
+            ]
+        # Sine: equal time steps along a cosine ease, fewer for fast strokes.
+        steps = max(1, min(SINE_STEPS, int(half / MIN_SEGMENT_DURATION)))
+        rise = [
+            round(low + (high - low) * (1 - math.cos(math.pi * step / steps)) / 2, 6)
+            for step in range(1, steps + 1)
+        ]
+        fall = [round(high + low - position, 6) for position in rise]
+        return [(half / steps, position) for position in rise + fall]
+
+
+async def async_run_trajectory(
+    queue: DeviceCommandQueue, index: int, trajectory: Trajectory
+) -> None:
+    """Stream a trajectory to a single linear feature.
+
+    Each move is sent ahead of the moment the previous one ends by the expected
+    send delay (the batch window plus half the smoothed round-trip time), so it
+    reaches the device just as the previous move completes. Moves are scheduled
+    against the monotonic clock and their durations are shortened when sent late,
+    so the stroke keeps its phase. Moves that can no longer be made in time are
+    skipped, and holds aren't sent at all.
+    """
+    segments = trajectory.segments()
+    total = len(segments) * trajectory.repeat if trajectory.repeat else math.inf
+    end = time.monotonic()
+    position: float | None = None
+    segment = 0
+    while segment < total:
+        duration, target = segments[segment % len(segments)]
+        segment += 1
+        begin, end = end, end + duration
+        lead = min(BATCH_WINDOW + (queue.limiter.srtt or 0) / 2, MAX_LEAD)
+        delay = begin - lead - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if target == position:
+            continue
+        remaining = end - time.monotonic() - lead
+        if remaining <= 0:
+            continue
+        position = target
+        queue.async_enqueue(
+            CMD_TYPE_LINEAR,
+            index,
+            make_payload(CMD_TYPE_LINEAR, target, round(remaining * 1000)),
+        )
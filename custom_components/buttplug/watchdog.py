@@ -0,0 +1,98 @@
+"""Inactivity watchdog stopping Buttplug devices that were left running."""
+from __future__ import annotations
+
+import asyncio
+import heapq
+from itertools import count
+import time
+from typing import TYPE_CHECKING
+
+from homeassistant.core import HomeAssistant, callback
+
+from .const import LOGGER
+
+if TYPE_CHECKING:
+    from .command_queue import DeviceCommandQueue
+
+
+class InactivityWatchdog:
+    """Stop devices whose last command is older than a timeout.
+
+    All devices of a config entry share one heap of deadlines and a single timer
+    for the earliest one. Each device has at most one entry in the heap: commands
+    only record when they were sent, and an entry that comes due for a device
+    that was commanded since is pushed back to its new deadline instead.
+    """
+
+    def __init__(self, hass: HomeAssistant, timeout: float) -> None:
+        """Initialize the watchdog; a timeout of 0 disables it."""
+        self.hass = hass
+        self.timeout = timeout
+        self._heap: list[tuple[float, int, DeviceCommandQueue]] = []
+        self._armed: set[DeviceCommandQueue] = set()
+        self._counter = count()
+        self._timer: asyncio.TimerHandle | None = None
+
+    @property
+    def enabled(self) -> bool:
+        """Return whether devices get stopped at all."""
+        return self.timeout > 0
+
+    @property
+    def watched(self) -> int:
+        """Return the number of devices being watched."""
+        return len(self._armed)
+
+    @callback
+    def async_touch(self, queue: DeviceCommandQueue) -> None:
+        """Start watching a device that was just sent a command."""
+        if not self.enabled or queue in self._armed:
+            return
+        self._armed.add(queue)
+        self._push(queue, queue.last_command + self.timeout)
+
+    def _push(self, queue: DeviceCommandQueue, deadline: float) -> None:
+        heapq.heappush(self._heap, (deadline, next(self._counter), queue))
+        if self._heap[0][2] is queue:
+            self._schedule()
+
+    def _schedule(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._heap:
+            self._timer = self.hass.loop.call_later(
+                max(0, self._heap[0][0] - time.monotonic()), self._async_fire
+            )
+
+    @callback
+    def _async_fire(self) -> None:
+        """Stop the devices that have been idle for too long."""
+        self._timer = None
+        now = time.monotonic()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, queue = heapq.heappop(self._heap)
+            if queue.last_command is None:
+                # Stopped or disconnected since.
+                self._armed.discard(queue)
+            elif (deadline := queue.last_command + self.timeout) > now:
+                heapq.heappush(self._heap, (deadline, next(self._counter), queue))
+            else:
+                self._armed.discard(queue)
+                if queue.device is not None:
+                    LOGGER.warning(
+                        "Stopping %s after %s s without commands",
+                        queue.device.name,
+                        self.timeout,
+                    )
+                    self.hass.async_create_task(queue.async_stop())
+        self._schedule()
+
+    @callback
+    def async_shutdown(self) -> None:
+        """Stop watching all devices."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._heap.clear()
+        self._armed.clear()